@@ -0,0 +1,96 @@
+import os
+import shutil
+
+import numpy as np
+from PIL import Image
+
+from wkcuber.cubing import cubing, create_parser
+from wkcuber.mag import Mag
+from wkcuber.utils import WkwDatasetInfo, open_wkw
+
+
+def write_sections(source_path: str, sizes: list) -> None:
+    shutil.rmtree(source_path, ignore_errors=True)
+    os.makedirs(source_path)
+    for z, (width, height) in enumerate(sizes):
+        section = np.random.randint(1, 255, (height, width), dtype=np.uint8)
+        Image.fromarray(section).save(os.path.join(source_path, "{:03}.png".format(z)))
+
+
+def cube_sections(source_path: str, target_path: str, *flags: str) -> None:
+    shutil.rmtree(target_path, ignore_errors=True)
+    args = create_parser().parse_args(
+        [source_path, target_path, "--wkw_file_len", "1", "--jobs", "2", *flags]
+    )
+    cubing(
+        args.source_path,
+        args.target_path,
+        args.layer_name,
+        args.dtype,
+        args.batch_size,
+        args,
+    )
+
+
+def test_column_cubing_equals_section_cubing():
+    for sizes, flags, target_mag in [
+        ([(150, 100)] * 40, [], "1"),
+        ([(150, 100)] * 40, ["--target_mag", "2-2-1"], "2-2-1"),
+        ([(150, 100), (70, 120), (30, 20)] * 4, ["--pad", "--batch_size", "5"], "1"),
+    ]:
+        write_sections("testoutput/column-cubing-source", sizes)
+        cube_sections(
+            "testoutput/column-cubing-source", "testoutput/section-cubing", *flags
+        )
+        cube_sections(
+            "testoutput/column-cubing-source",
+            "testoutput/column-cubing",
+            "--column_size",
+            "40",
+            *flags
+        )
+
+        mag = Mag(target_mag)
+        size = tuple(
+            -(-max(section_size[dim] for section_size in sizes) // mag.mag[dim])
+            for dim in range(2)
+        ) + (len(sizes) // mag.mag[2],)
+        with open_wkw(
+            WkwDatasetInfo("testoutput/section-cubing", "color", mag, None)
+        ) as section_wkw:
+            section_buffer = section_wkw.read((0, 0, 0), size)
+        with open_wkw(
+            WkwDatasetInfo("testoutput/column-cubing", "color", mag, None)
+        ) as column_wkw:
+            column_buffer = column_wkw.read((0, 0, 0), size)
+        assert np.any(section_buffer)
+        assert np.array_equal(section_buffer, column_buffer)
+
+
+def test_cubing_writes_all_batches():
+    sizes = [(150, 100), (70, 120), (30, 20)] * 7
+    write_sections("testoutput/batch-cubing-source", sizes)
+    sections = [
+        np.array(Image.open("testoutput/batch-cubing-source/{:03}.png".format(z))).T
+        for z in range(len(sizes))
+    ]
+    for prefetch_slices in ["0", "4"]:
+        # The batches are written in the background while the next ones are read
+        cube_sections(
+            "testoutput/batch-cubing-source",
+            "testoutput/batch-cubing",
+            "--pad",
+            "--batch_size",
+            "4",
+            "--prefetch_slices",
+            prefetch_slices,
+        )
+        with open_wkw(
+            WkwDatasetInfo("testoutput/batch-cubing", "color", Mag(1), None)
+        ) as target_wkw:
+            cubed_buffer = target_wkw.read((0, 0, 0), (150, 120, len(sizes)))[0]
+        for z, section in enumerate(sections):
+            width, height = section.shape
+            assert np.array_equal(cubed_buffer[:width, :height, z], section)
+            assert not np.any(cubed_buffer[width:, :, z])
+            assert not np.any(cubed_buffer[:, height:, z])
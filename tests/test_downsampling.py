@@ -1,4 +1,6 @@
 import logging
+from collections import defaultdict
+from itertools import product
 from typing import Tuple
 
 import numpy as np
@@ -8,12 +10,36 @@ from wkcuber.downsampling import (
     downsample_cube_job,
     cube_addresses,
     get_next_anisotropic_mag,
+    downsample_mags_isotropic,
+    downsample,
+    plan_downsampling,
+    determine_cubes_per_job,
+    DownsamplingJournal,
+    create_downsampling_journal,
+    downsample_mag,
+    JOURNAL_FILE_NAME,
 )
+import wkcuber.downsampling
+from argparse import Namespace
 import wkw
 from wkcuber.mag import Mag
-from wkcuber.utils import WkwDatasetInfo, open_wkw
-from wkcuber.downsampling import _mode, non_linear_filter_3d
+from wkcuber.utils import (
+    WkwDatasetInfo,
+    open_wkw,
+    ensure_wkw,
+    bounding_box_cube_addresses,
+)
+from wkcuber.api.bounding_box import BoundingBox
+from wkcuber.downsampling import (
+    _mode,
+    _label_mode,
+    _median,
+    _sort_mode,
+    non_linear_filter_3d,
+)
+from scipy.ndimage import zoom
 import shutil
+import os
 
 WKW_CUBE_SIZE = 1024
 CUBE_EDGE_LEN = 256
@@ -199,6 +225,21 @@ def test_downsample_multi_channel():
     assert np.all(target_buffer == joined_buffer)
 
 
+def test_downsample_cube_vectorizes_channels():
+    num_channels = 3
+    data = np.asfortranarray(
+        np.random.randint(0, 4, (num_channels, 32, 32, 16)).astype(np.uint8)
+    )
+    for interpolation_mode in InterpolationModes:
+        for factors in [[2, 2, 2], [2, 2, 1]]:
+            output = downsample_cube(data, factors, interpolation_mode)
+            for channel_index in range(num_channels):
+                assert np.all(
+                    output[channel_index]
+                    == downsample_cube(data[channel_index], factors, interpolation_mode)
+                )
+
+
 def test_anisotropic_mag_calculation():
     mag_tests = [
         [(10.5, 10.5, 24), Mag(1), Mag((2, 2, 1))],
@@ -223,3 +264,703 @@ def test_anisotropic_mag_calculation():
             f"the size {mag_tests[i][0]} should be {mag_tests[i][2]} "
             f"and not {next_mag}"
         )
+
+
+def test_fused_downsampling_equals_sequential_downsampling():
+    size = (96, 64, 64)
+    source_data = (128 * np.random.randn(1, *size)).astype("uint8")
+    file_len = 1
+
+    for dataset_path in ["testoutput/sequential-test", "testoutput/fused-test"]:
+        shutil.rmtree(dataset_path, ignore_errors=True)
+        source_info = WkwDatasetInfo(
+            dataset_path, "color", 1, wkw.Header(np.uint8, file_len=file_len)
+        )
+        with open_wkw(source_info) as wkw_dataset:
+            wkw_dataset.write((0, 0, 0), source_data)
+
+    downsample_mags_isotropic(
+        "testoutput/sequential-test", "color", Mag(1), Mag(8), "max", False
+    )
+    downsample_mags_isotropic(
+        "testoutput/fused-test", "color", Mag(1), Mag(8), "max", False, mags_per_job=3
+    )
+
+    for mag in [2, 4, 8]:
+        mag_size = tuple(dim // mag for dim in size)
+        sequential_buffer = read_wkw(
+            WkwDatasetInfo("testoutput/sequential-test", "color", mag, None),
+            (0, 0, 0),
+            mag_size,
+        )
+        fused_buffer = read_wkw(
+            WkwDatasetInfo("testoutput/fused-test", "color", mag, None),
+            (0, 0, 0),
+            mag_size,
+        )
+        assert np.any(fused_buffer != 0)
+        assert np.all(sequential_buffer == fused_buffer)
+
+
+def test_pipelined_downsampling_equals_mag_by_mag_downsampling():
+    size = (256, 64, 64)
+    source_data = (128 * np.random.randn(1, *size)).astype("uint8")
+    # Leave some cubes empty, so that some target cubes are skipped
+    source_data[:, 64:160] = 0
+    file_len = 1
+
+    for dataset_path in ["testoutput/mag-by-mag-test", "testoutput/pipelined-test"]:
+        shutil.rmtree(dataset_path, ignore_errors=True)
+        source_info = WkwDatasetInfo(
+            dataset_path, "color", 1, wkw.Header(np.uint8, file_len=file_len)
+        )
+        with open_wkw(source_info) as wkw_dataset:
+            wkw_dataset.write((0, 0, 0), source_data)
+
+    source_mag = Mag(1)
+    for target_mag in [Mag(2), Mag(4), Mag(8)]:
+        downsample_mag(
+            "testoutput/mag-by-mag-test",
+            "color",
+            source_mag,
+            target_mag,
+            "median",
+            False,
+        )
+        source_mag = target_mag
+    downsample_mags_isotropic(
+        "testoutput/pipelined-test",
+        "color",
+        Mag(1),
+        Mag(8),
+        "median",
+        False,
+        args=Namespace(distribution_strategy="multiprocessing", jobs=2),
+    )
+
+    for mag in [2, 4, 8]:
+        mag_by_mag_info = WkwDatasetInfo(
+            "testoutput/mag-by-mag-test", "color", mag, None
+        )
+        pipelined_info = WkwDatasetInfo("testoutput/pipelined-test", "color", mag, None)
+        assert cube_addresses(pipelined_info) == cube_addresses(mag_by_mag_info)
+        mag_size = tuple(dim // mag for dim in size)
+        assert np.all(
+            read_wkw(pipelined_info, (0, 0, 0), mag_size)
+            == read_wkw(mag_by_mag_info, (0, 0, 0), mag_size)
+        )
+        assert not os.path.exists(
+            os.path.join(
+                "testoutput/pipelined-test", "color", str(mag), JOURNAL_FILE_NAME
+            )
+        )
+
+
+def test_pipelined_downsampling_submits_full_batches(monkeypatch):
+    dataset_path = "testoutput/pipelined-batches-test"
+    shutil.rmtree(dataset_path, ignore_errors=True)
+    source_info = WkwDatasetInfo(
+        dataset_path, "color", 1, wkw.Header(np.uint8, file_len=1)
+    )
+    with open_wkw(source_info) as wkw_dataset:
+        wkw_dataset.write((0, 0, 0), np.ones((1, 256, 256, 128), dtype=np.uint8))
+
+    # The cube counts of the jobs of every mag
+    batch_sizes = defaultdict(list)
+    get_executor_for_args = wkcuber.downsampling.get_executor_for_args
+
+    def get_recording_executor(args):
+        executor = get_executor_for_args(args)
+        map_to_futures = executor.map_to_futures
+
+        def record_jobs(fn, job_args):
+            for job in job_args:
+                batch_sizes[job[1].mag].append(len(job[4]))
+            return map_to_futures(fn, job_args)
+
+        executor.map_to_futures = record_jobs
+        return executor
+
+    monkeypatch.setattr(
+        wkcuber.downsampling, "get_executor_for_args", get_recording_executor
+    )
+    downsample_mags_isotropic(
+        dataset_path,
+        "color",
+        Mag(1),
+        Mag(8),
+        "max",
+        False,
+        args=Namespace(
+            distribution_strategy="multiprocessing", jobs=2, cubes_per_job=8
+        ),
+    )
+
+    assert dict(batch_sizes) == {"2": [8, 8, 8, 8], "4": [4], "8": [1]}
+
+
+def test_downsampling_skips_empty_target_cubes():
+    dataset_path = "testoutput/sparse-test"
+    shutil.rmtree(dataset_path, ignore_errors=True)
+    file_len = 1
+    source_info = WkwDatasetInfo(
+        dataset_path, "segmentation", 1, wkw.Header(np.uint32, file_len=file_len)
+    )
+    stale_target_info = WkwDatasetInfo(
+        dataset_path, "segmentation", 2, wkw.Header(np.uint32, file_len=file_len)
+    )
+    with open_wkw(source_info) as wkw_dataset:
+        wkw_dataset.write((0, 0, 0), np.ones((1, 32, 32, 32), dtype=np.uint32))
+        # This cube exists on disk, but does not contain any data
+        wkw_dataset.write((64, 0, 0), np.zeros((1, 32, 32, 32), dtype=np.uint32))
+    with open_wkw(stale_target_info) as wkw_dataset:
+        # This cube will be empty after downsampling and must be removed
+        wkw_dataset.write((32, 0, 0), np.ones((1, 32, 32, 32), dtype=np.uint32))
+
+    non_empty_cube_addresses = downsample(
+        source_info,
+        stale_target_info,
+        Mag(1),
+        Mag(2),
+        InterpolationModes.MODE,
+        False,
+    )
+
+    assert non_empty_cube_addresses == [(0, 0, 0)]
+    assert cube_addresses(stale_target_info) == [(0, 0, 0)]
+    assert np.all(read_wkw(stale_target_info, (0, 0, 0), (16, 16, 16)) == 1)
+
+
+def test_incremental_downsampling_equals_full_downsampling():
+    size = (256, 64, 64)
+    source_data = (128 * np.random.randn(1, *size)).astype("uint8")
+    patch = (128 * np.random.randn(1, 32, 32, 32)).astype("uint8")
+    file_len = 1
+
+    # Fused jobs read the cubes of the intermediate mags which are not dirty
+    for mags_per_job in [1, 3]:
+        for dataset_path in ["testoutput/full-test", "testoutput/incremental-test"]:
+            shutil.rmtree(dataset_path, ignore_errors=True)
+            source_info = WkwDatasetInfo(
+                dataset_path, "color", 1, wkw.Header(np.uint8, file_len=file_len)
+            )
+            with open_wkw(source_info) as wkw_dataset:
+                wkw_dataset.write((0, 0, 0), source_data)
+        downsample_mags_isotropic(
+            "testoutput/incremental-test",
+            "color",
+            Mag(1),
+            Mag(8),
+            "max",
+            False,
+            mags_per_job=mags_per_job,
+        )
+
+        # Patch one cube and clear another one completely
+        for dataset_path in ["testoutput/full-test", "testoutput/incremental-test"]:
+            with open_wkw(
+                WkwDatasetInfo(dataset_path, "color", 1, None)
+            ) as wkw_dataset:
+                wkw_dataset.write((32, 0, 32), patch)
+                wkw_dataset.write((96, 32, 32), np.zeros_like(patch))
+
+        untouched_cube = "testoutput/incremental-test/color/2/z0/y0/x2.wkw"
+        untouched_mtime = os.path.getmtime(untouched_cube)
+        downsample_mags_isotropic(
+            "testoutput/full-test", "color", Mag(1), Mag(8), "max", False
+        )
+        downsample_mags_isotropic(
+            "testoutput/incremental-test",
+            "color",
+            Mag(1),
+            Mag(8),
+            "max",
+            False,
+            mags_per_job=mags_per_job,
+            dirty_cube_addresses=[(1, 0, 1), (3, 1, 1)],
+        )
+        assert os.path.getmtime(untouched_cube) == untouched_mtime
+
+        for mag in [2, 4, 8]:
+            mag_size = tuple(dim // mag for dim in size)
+            full_buffer = read_wkw(
+                WkwDatasetInfo("testoutput/full-test", "color", mag, None),
+                (0, 0, 0),
+                mag_size,
+            )
+            incremental_buffer = read_wkw(
+                WkwDatasetInfo("testoutput/incremental-test", "color", mag, None),
+                (0, 0, 0),
+                mag_size,
+            )
+            assert np.all(full_buffer == incremental_buffer)
+
+
+def test_downsampling_removes_stale_cubes_of_upper_mags():
+    size = (512, 64, 64)
+    dataset_path = "testoutput/stale-test"
+    source_info = WkwDatasetInfo(
+        dataset_path, "color", 1, wkw.Header(np.uint8, file_len=1)
+    )
+
+    # A full run and a run of the bounding box of the cleared source cubes
+    cleared_bbox = BoundingBox((256, 0, 0), (256, 64, 64))
+    for mags_per_job, bbox in product([1, 2, 3], [None, cleared_bbox]):
+        shutil.rmtree(dataset_path, ignore_errors=True)
+        with open_wkw(source_info) as wkw_dataset:
+            wkw_dataset.write(
+                (0, 0, 0), np.random.randint(1, 255, (1, *size), dtype=np.uint8)
+            )
+        downsample_mags_isotropic(
+            dataset_path,
+            "color",
+            Mag(1),
+            Mag(8),
+            "max",
+            False,
+            mags_per_job=mags_per_job,
+        )
+
+        # The second half of the source data is cleared and downsampled again
+        with open_wkw(source_info) as wkw_dataset:
+            wkw_dataset.write((256, 0, 0), np.zeros((1, 256, 64, 64), np.uint8))
+        downsample_mags_isotropic(
+            dataset_path,
+            "color",
+            Mag(1),
+            Mag(8),
+            "max",
+            False,
+            mags_per_job=mags_per_job,
+            bbox=bbox,
+        )
+
+        for mag in [2, 4, 8]:
+            target_info = WkwDatasetInfo(dataset_path, "color", mag, None)
+            cleared_offset = 256 // mag
+            cleared_size = (cleared_offset, 64 // mag, 64 // mag)
+            assert np.all(read_wkw(target_info, (0, 0, 0), cleared_size))
+            assert not np.any(
+                read_wkw(target_info, (cleared_offset, 0, 0), cleared_size)
+            )
+            assert all(
+                x * 32 < cleared_offset for x, _, _ in cube_addresses(target_info)
+            )
+
+
+def test_bounding_box_downsampling_equals_full_downsampling():
+    size = (256, 64, 64)
+    source_data = (128 * np.random.randn(1, *size)).astype("uint8")
+    file_len = 1
+
+    for dataset_path in ["testoutput/full-test", "testoutput/bbox-test"]:
+        shutil.rmtree(dataset_path, ignore_errors=True)
+        source_info = WkwDatasetInfo(
+            dataset_path, "color", 1, wkw.Header(np.uint8, file_len=file_len)
+        )
+        with open_wkw(source_info) as wkw_dataset:
+            wkw_dataset.write((0, 0, 0), source_data)
+
+    bbox = BoundingBox((70, 10, 0), (20, 20, 20))
+    for mags_per_job in [1, 2]:
+        shutil.rmtree("testoutput/bbox-test/color/2", ignore_errors=True)
+        shutil.rmtree("testoutput/bbox-test/color/4", ignore_errors=True)
+        downsample_mags_isotropic(
+            "testoutput/bbox-test",
+            "color",
+            Mag(1),
+            Mag(4),
+            "max",
+            False,
+            mags_per_job=mags_per_job,
+            bbox=bbox,
+        )
+        # Only the cubes which intersect the bounding box are written
+        assert cube_addresses(
+            WkwDatasetInfo("testoutput/bbox-test", "color", 2, None)
+        ) == [(1, 0, 0)]
+        assert cube_addresses(
+            WkwDatasetInfo("testoutput/bbox-test", "color", 4, None)
+        ) == [(0, 0, 0)]
+
+    downsample_mags_isotropic(
+        "testoutput/full-test", "color", Mag(1), Mag(4), "max", False
+    )
+    # The region of the cube of mag 2 which intersects the bounding box
+    for mag, offset, cube_size in [
+        (2, (32, 0, 0), (32, 32, 32)),
+        (4, (16, 0, 0), (16, 16, 16)),
+    ]:
+        full_buffer = read_wkw(
+            WkwDatasetInfo("testoutput/full-test", "color", mag, None),
+            offset,
+            cube_size,
+        )
+        bbox_buffer = read_wkw(
+            WkwDatasetInfo("testoutput/bbox-test", "color", mag, None),
+            offset,
+            cube_size,
+        )
+        assert np.all(full_buffer == bbox_buffer)
+
+    # On a dataset which was downsampled before, the existing cubes outside of
+    # the bounding box are kept and used for the cubes of the upper mags
+    for mags_per_job in [1, 3]:
+        for mag in [2, 4, 8]:
+            shutil.rmtree(
+                "testoutput/bbox-test/color/{}".format(mag), ignore_errors=True
+            )
+        downsample_mags_isotropic(
+            "testoutput/bbox-test",
+            "color",
+            Mag(1),
+            Mag(8),
+            "max",
+            False,
+            mags_per_job=mags_per_job,
+        )
+        downsampled_buffers = []
+        for mag in [2, 4, 8]:
+            downsampled_buffers.append(
+                read_wkw(
+                    WkwDatasetInfo("testoutput/bbox-test", "color", mag, None),
+                    (0, 0, 0),
+                    tuple(dim // mag for dim in size),
+                )
+            )
+        downsample_mags_isotropic(
+            "testoutput/bbox-test",
+            "color",
+            Mag(1),
+            Mag(8),
+            "max",
+            False,
+            mags_per_job=mags_per_job,
+            bbox=bbox,
+        )
+        for mag, downsampled_buffer in zip([2, 4, 8], downsampled_buffers):
+            bbox_buffer = read_wkw(
+                WkwDatasetInfo("testoutput/bbox-test", "color", mag, None),
+                (0, 0, 0),
+                tuple(dim // mag for dim in size),
+            )
+            assert np.all(downsampled_buffer == bbox_buffer)
+
+
+def test_bounding_box_cube_addresses():
+    with open_wkw(
+        WkwDatasetInfo(
+            "testoutput/bbox-cubes-test", "color", 2, wkw.Header(np.uint8, file_len=1)
+        )
+    ) as wkw_dataset:
+        bbox = BoundingBox((10, 0, 32), (60, 32, 1)).align_with_mag(Mag(2), True)
+        assert bounding_box_cube_addresses(wkw_dataset, bbox.in_mag(Mag(2))) == [
+            (0, 0, 0),
+            (1, 0, 0),
+        ]
+        bbox = BoundingBox((0, 0, 64), (66, 1, 1))
+        assert bounding_box_cube_addresses(wkw_dataset, bbox) == [
+            (0, 0, 2),
+            (1, 0, 2),
+            (2, 0, 2),
+        ]
+
+
+def test_batched_downsampling_equals_single_cube_downsampling():
+    size = (256, 64, 64)
+    source_data = (128 * np.random.randn(1, *size)).astype("uint8")
+    file_len = 1
+
+    for dataset_path, cubes_per_job in [
+        ("testoutput/single-cube-jobs-test", 1),
+        ("testoutput/batched-jobs-test", 3),
+    ]:
+        shutil.rmtree(dataset_path, ignore_errors=True)
+        source_info = WkwDatasetInfo(
+            dataset_path, "color", 1, wkw.Header(np.uint8, file_len=file_len)
+        )
+        with open_wkw(source_info) as wkw_dataset:
+            wkw_dataset.write((0, 0, 0), source_data)
+            # An empty cube in the middle of a batch
+            wkw_dataset.write((64, 0, 0), np.zeros((1, 64, 64, 64), dtype=np.uint8))
+        args = Namespace(
+            distribution_strategy="multiprocessing", jobs=2, cubes_per_job=cubes_per_job
+        )
+        non_empty_cube_addresses = downsample(
+            source_info,
+            WkwDatasetInfo(dataset_path, "color", 2, wkw.Header(np.uint8)),
+            Mag(1),
+            Mag(2),
+            InterpolationModes.MAX,
+            False,
+            args=args,
+        )
+        assert len(non_empty_cube_addresses) == 3
+
+    single_cube_buffer = read_wkw(
+        WkwDatasetInfo("testoutput/single-cube-jobs-test", "color", 2, None),
+        (0, 0, 0),
+        (128, 32, 32),
+    )
+    batched_buffer = read_wkw(
+        WkwDatasetInfo("testoutput/batched-jobs-test", "color", 2, None),
+        (0, 0, 0),
+        (128, 32, 32),
+    )
+    assert np.any(batched_buffer != 0)
+    assert np.all(single_cube_buffer == batched_buffer)
+
+
+def test_determine_cubes_per_job():
+    args = Namespace(distribution_strategy="multiprocessing", jobs=4)
+    # Large cubes are not grouped
+    assert determine_cubes_per_job(1000, 1024 ** 3, args) == 1
+    # Small cubes are grouped up to a gigavoxel per job ...
+    assert determine_cubes_per_job(1000000, 32 ** 3, args) == 32768
+    # ... as long as every worker gets a job
+    assert determine_cubes_per_job(1000, 32 ** 3, args) == 250
+    # Without args, every cpu counts as a worker
+    assert determine_cubes_per_job(1, 32 ** 3, None) == 1
+
+    # Slurm ignores --jobs, so only the voxel budget applies
+    slurm_args = Namespace(distribution_strategy="slurm", jobs=4)
+    assert determine_cubes_per_job(1000, 32 ** 3, slurm_args) == 32768
+    assert determine_cubes_per_job(1000, 1024 ** 3, slurm_args) == 1
+
+    args.cubes_per_job = 16
+    assert determine_cubes_per_job(1000, 32 ** 3, args) == 16
+
+
+def test_downsampling_resumes_from_journal():
+    dataset_path = "testoutput/journal-test"
+    shutil.rmtree(dataset_path, ignore_errors=True)
+    source_info = WkwDatasetInfo(
+        dataset_path, "color", 1, wkw.Header(np.uint8, file_len=1)
+    )
+    target_info = WkwDatasetInfo(
+        dataset_path, "color", 2, wkw.Header(np.uint8, file_len=1)
+    )
+    with open_wkw(source_info) as wkw_dataset:
+        wkw_dataset.write((0, 0, 0), np.ones((1, 128, 32, 32), dtype=np.uint8))
+    ensure_wkw(target_info)
+
+    def run_with_journal(description):
+        journal = DownsamplingJournal(target_info, description)
+        journal.start()
+        # The job of this cube finished before the run was interrupted
+        journal.record((1, 0, 0), True)
+        journal.close()
+        return downsample(
+            source_info, target_info, Mag(1), Mag(2), InterpolationModes.MAX, False
+        )
+
+    description = {
+        "source_mag": "1",
+        "target_mag": "2",
+        "interpolation_mode": "MAX",
+        "compress": False,
+    }
+    assert run_with_journal(description) == [(0, 0, 0), (1, 0, 0)]
+    # The journaled cube was skipped
+    assert cube_addresses(target_info) == [(0, 0, 0)]
+    assert not os.path.exists(DownsamplingJournal(target_info, description).path)
+
+    # The journal of a different run is ignored
+    assert run_with_journal({**description, "interpolation_mode": "MIN"}) == [
+        (0, 0, 0),
+        (1, 0, 0),
+    ]
+    assert cube_addresses(target_info) == [(0, 0, 0), (1, 0, 0)]
+
+
+def test_dirty_downsampling_ignores_journal_of_full_run():
+    dataset_path = "testoutput/dirty-journal-test"
+    shutil.rmtree(dataset_path, ignore_errors=True)
+    source_info = WkwDatasetInfo(
+        dataset_path, "color", 1, wkw.Header(np.uint8, file_len=1)
+    )
+    target_info = WkwDatasetInfo(dataset_path, "color", 2, None)
+    with open_wkw(source_info) as wkw_dataset:
+        wkw_dataset.write((0, 0, 0), np.ones((1, 128, 32, 32), dtype=np.uint8))
+    downsample_mags_isotropic(dataset_path, "color", Mag(1), Mag(2), "max", False)
+
+    # A full run was interrupted after it had journaled this cube ...
+    journal = create_downsampling_journal(
+        target_info, Mag(1), Mag(2), InterpolationModes.MAX, False
+    )
+    journal.start()
+    journal.record((0, 0, 0), True)
+    journal.close()
+    # ... which was changed before the dirty run
+    with open_wkw(source_info) as wkw_dataset:
+        wkw_dataset.write((32, 0, 0), np.full((1, 32, 32, 32), 2, dtype=np.uint8))
+    downsample_mags_isotropic(
+        dataset_path,
+        "color",
+        Mag(1),
+        Mag(2),
+        "max",
+        False,
+        dirty_cube_addresses=[(1, 0, 0)],
+    )
+
+    assert np.all(read_wkw(target_info, (16, 0, 0), (16, 16, 16)) == 2)
+    assert not os.path.exists(journal.path)
+
+
+def test_pairwise_mode_equals_sort_mode():
+    for dtype in [np.uint8, np.uint32, np.uint64]:
+        # Few distinct values, so that there are many ties and majorities
+        data = np.random.randint(0, 3, (64, 64, 32)).astype(dtype)
+        data = np.asfortranarray(data)
+        for factors in [[2, 2, 2], [2, 2, 1], [1, 2, 2], [4, 2, 1], [2, 1, 1]]:
+            assert np.all(
+                downsample_cube(data, factors, InterpolationModes.MODE)
+                == non_linear_filter_3d(
+                    data, factors, lambda votes: _sort_mode(np.stack(votes))
+                )
+            )
+
+
+def test_label_mode_equals_sort_mode():
+    for dtype in [np.uint32, np.uint64]:
+        # Large uniform regions whose borders do not align with the blocks,
+        # plus noise, so that there are uniform and mixed blocks with ties
+        data = np.random.randint(0, 4, (8, 8, 4)).astype(dtype)
+        data = np.repeat(np.repeat(np.repeat(data, 16, 0), 16, 1), 16, 2)
+        data = np.roll(data, (3, 1, 5), axis=(0, 1, 2))
+        noise = np.random.random(data.shape) < 0.01
+        data[noise] = np.random.randint(0, 4, np.count_nonzero(noise))
+        data *= np.iinfo(dtype).max // 4
+        data = np.asfortranarray(data)
+        for factors in [[2, 2, 2], [2, 2, 1], [4, 4, 4], [4, 2, 1], [2, 1, 1]]:
+            sort_mode_result = non_linear_filter_3d(
+                data, factors, lambda votes: _sort_mode(np.stack(votes))
+            )
+            # downsample_cube uses the JIT kernel instead if numba is installed
+            assert np.all(
+                non_linear_filter_3d(data, factors, _label_mode) == sort_mode_result
+            )
+            assert np.all(
+                downsample_cube(data, factors, InterpolationModes.LABEL_MODE)
+                == sort_mode_result
+            )
+
+    uniform = np.full((8, 8, 8), 42, dtype=np.uint64, order="F")
+    assert np.all(
+        downsample_cube(uniform, [2, 2, 2], InterpolationModes.LABEL_MODE) == 42
+    )
+
+
+def test_separable_linear_filter_equals_zoom():
+    data = np.random.randint(0, 255, (64, 64, 32)).astype(np.uint8)
+    for data in [data, np.asfortranarray(data)]:
+        for factors in [[2, 2, 2], [2, 2, 1], [4, 2, 1], [1, 1, 2]]:
+            for interpolation_mode, order in [
+                (InterpolationModes.NEAREST, 0),
+                (InterpolationModes.BILINEAR, 1),
+                (InterpolationModes.BICUBIC, 2),
+            ]:
+                output = downsample_cube(data, factors, interpolation_mode)
+                assert output.dtype == data.dtype
+                assert np.array_equal(
+                    output,
+                    zoom(
+                        data,
+                        [1 / factor for factor in factors],
+                        output=data.dtype,
+                        order=order,
+                        mode="nearest",
+                        prefilter=True,
+                    ),
+                )
+
+
+def test_downsample_cube_into_preallocated_output():
+    data = np.random.randint(0, 255, (2, 64, 64, 32)).astype(np.uint8)
+    data = np.asfortranarray(data)
+    for interpolation_mode in [InterpolationModes.MEDIAN, InterpolationModes.BILINEAR]:
+        out = np.empty((2, 32, 32, 32), dtype=np.uint8, order="F")
+        output = downsample_cube(data, [2, 2, 1], interpolation_mode, out=out)
+        assert output is out
+        assert np.array_equal(out, downsample_cube(data, [2, 2, 1], interpolation_mode))
+
+
+def test_integer_median_equals_float_median():
+    for dtype in [np.uint8, np.uint16]:
+        data = np.random.randint(0, np.iinfo(dtype).max, (64, 64, 32)).astype(dtype)
+        data = np.asfortranarray(data)
+        for factors in [[2, 2, 2], [2, 2, 1], [2, 1, 1], [4, 4, 4], [4, 4, 2]]:
+            output = downsample_cube(data, factors, InterpolationModes.MEDIAN)
+            assert output.dtype == dtype
+            assert np.all(
+                output
+                == non_linear_filter_3d(
+                    data,
+                    factors,
+                    lambda votes: np.median(votes, axis=0).astype(votes[0].dtype),
+                )
+            )
+
+    a = np.array([[1, 3, 4, 2, 2, 7], [5, 2, 2, 1, 4, 1], [3, 3, 2, 2, 1, 1]])
+    assert np.all(_median(a.astype(np.uint8)) == np.array([3, 3, 2, 2, 2, 1]))
+
+
+def test_downsample_average():
+    for dtype in [np.uint8, np.uint16, np.int16, np.uint32, np.uint64, np.int64]:
+        info = np.iinfo(dtype)
+        data = np.random.randint(
+            max(info.min, -(2 ** 62)), min(info.max, 2 ** 62), (32, 32, 16)
+        ).astype(dtype)
+        data = np.asfortranarray(data)
+        for factors in [[2, 2, 2], [2, 2, 1], [4, 4, 4]]:
+            output = downsample_cube(data, factors, InterpolationModes.AVERAGE)
+            assert output.dtype == dtype
+            expected_result = non_linear_filter_3d(
+                data.astype(object),
+                factors,
+                lambda votes: (sum(votes) + len(votes) // 2) // len(votes),
+            )
+            assert np.all(output == expected_result)
+
+    # The extreme values must neither overflow the accumulator ...
+    data = np.full((4, 4, 4), np.iinfo(np.uint64).max, dtype=np.uint64)
+    assert np.all(
+        downsample_cube(data, [2, 2, 2], InterpolationModes.AVERAGE)
+        == np.iinfo(np.uint64).max
+    )
+    # ... and means are rounded half up
+    a = np.array([[[1, 2], [1, 2]], [[1, 2], [1, 2]]], dtype=np.uint8)
+    assert np.all(downsample_cube(a, [2, 2, 2], InterpolationModes.AVERAGE) == [2])
+
+    a = np.array([[[0.5, 1], [1, 1]], [[1, 1], [1, 1]]], dtype=np.float32)
+    assert np.all(
+        downsample_cube(a, [2, 2, 2], InterpolationModes.AVERAGE) == [7.5 / 8]
+    )
+
+
+def test_plan_downsampling():
+    header = wkw.Header(np.uint8, file_len=32)
+    cube_size = 1024 ** 3
+
+    # The memory of a slurm job is limited by its job resources
+    args = Namespace(distribution_strategy="slurm", job_resources='{"mem": "10G"}')
+    plan = plan_downsampling(header, [[2, 2, 2]], None, args)
+    assert plan.buffer_edge_len == 256
+    assert plan.jobs is None
+    assert plan.memory_per_job == 2 * cube_size + 4 * 8 * 256 ** 3
+
+    args = Namespace(distribution_strategy="slurm", job_resources='{"mem": "2500M"}')
+    plan = plan_downsampling(header, [[2, 2, 2]], None, args)
+    assert plan.buffer_edge_len == 128
+    assert plan.memory_per_job <= 2500 * 1024 ** 2
+
+    # An explicit buffer edge length is kept
+    plan = plan_downsampling(header, [[2, 2, 2]], 64, args)
+    assert plan.buffer_edge_len == 64
+
+    # Multiple channels and larger dtypes need more memory
+    header = wkw.Header(np.uint16, num_channels=3, file_len=32)
+    plan = plan_downsampling(header, [[2, 2, 2], [2, 2, 2]], None, args)
+    assert plan.buffer_edge_len == 32
+    assert plan.memory_per_job == 4 * 6 * cube_size + 4 * 6 * 8 * 32 ** 3
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from wkcuber.downsampling import (
+    InterpolationModes,
+    downsample_cube,
+    non_linear_filter_3d,
+    _mode,
+    _label_mode,
+    _median,
+    _average,
+)
+from wkcuber.downsampling_jit import downsample_cube_jit
+
+pytest.importorskip("numba")
+
+FACTORS = [[2, 2, 2], [2, 2, 1], [4, 4, 4], [4, 2, 1], [1, 1, 2]]
+
+
+def test_jit_kernels_equal_numpy_filters():
+    for dtype in [np.uint8, np.uint16, np.uint32, np.uint64]:
+        info = np.iinfo(dtype)
+        # Few distinct values (for ties in the mode) including the maximum
+        # value (for overflows in the median and the average)
+        data = np.random.randint(0, 4, (32, 32, 16)).astype(dtype)
+        data *= info.max // 3
+        data = np.asfortranarray(data)
+        for factors in FACTORS:
+            for kernel_name, numpy_filter in [
+                ("mode", _mode),
+                ("median", _median),
+                ("average", _average),
+            ]:
+                assert np.array_equal(
+                    downsample_cube_jit(data, factors, kernel_name),
+                    non_linear_filter_3d(data, factors, numpy_filter),
+                )
+
+
+def test_jit_mode_equals_label_mode():
+    # LABEL_MODE uses the JIT mode kernel for 32 and 64 bit labels
+    for dtype in [np.uint32, np.uint64]:
+        for label_count in [4, 2 ** 20]:
+            # Uniform regions with noise (ties for few labels, many labels per
+            # block otherwise) and pure noise, for which _label_mode falls back
+            # to the regular mode
+            segments = np.random.randint(0, label_count, (8, 8, 4)).astype(dtype)
+            segments = np.repeat(np.repeat(np.repeat(segments, 4, 0), 4, 1), 4, 2)
+            segments = np.roll(segments, (1, 2, 3), axis=(0, 1, 2))
+            noise = np.random.random(segments.shape) < 0.01
+            segments[noise] = np.random.randint(0, label_count, np.count_nonzero(noise))
+            labels = np.random.randint(0, label_count, (32, 32, 16)).astype(dtype)
+            for data in [segments, labels]:
+                data = np.asfortranarray(data * (np.iinfo(dtype).max // label_count))
+                for factors in FACTORS:
+                    assert np.array_equal(
+                        downsample_cube(data, factors, InterpolationModes.LABEL_MODE),
+                        non_linear_filter_3d(data, factors, _label_mode),
+                    )
+
+
+def test_jit_kernels_support_multiple_channels():
+    data = np.random.randint(0, 4, (3, 32, 32, 16)).astype(np.uint32)
+    for data in [data, np.asfortranarray(data)]:
+        output = downsample_cube_jit(data, [2, 2, 2], "mode")
+        assert output.shape == (3, 16, 16, 8)
+        assert np.array_equal(output, non_linear_filter_3d(data, [2, 2, 2], _mode))
+
+
+def test_jit_kernels_fall_back_to_numpy():
+    data = np.random.random((16, 16, 16)).astype(np.float32)
+    assert downsample_cube_jit(data, [2, 2, 2], "median") is None
+    assert downsample_cube_jit(data.astype(np.int16), [2, 2, 2], "average") is None
+    assert downsample_cube_jit(data, [2, 2, 2], "bilinear") is None
+    assert np.array_equal(
+        downsample_cube(data, [2, 2, 2], InterpolationModes.MEDIAN),
+        non_linear_filter_3d(data, [2, 2, 2], _median),
+    )
@@ -0,0 +1,70 @@
+import os
+import shutil
+
+import numpy as np
+import tifffile
+from PIL import Image
+
+from wkcuber.image_readers import image_reader, memmap_page
+
+SOURCE_PATH = "testoutput/image-readers"
+REGIONS = [((0, 300), (0, 200)), ((13, 270), (70, 71)), ((256, 300), (128, 200))]
+
+
+def write_images() -> dict:
+    shutil.rmtree(SOURCE_PATH, ignore_errors=True)
+    os.makedirs(SOURCE_PATH)
+    data = np.random.randint(0, 255, (200, 300), dtype=np.uint8)
+    file_names = {
+        "striped": dict(rowsperstrip=7),
+        "tiled": dict(tile=(64, 32)),
+        "compressed": dict(tile=(32, 64), compression="zlib"),
+        "jpeg": dict(tile=(64, 64), compression="jpeg"),
+    }
+    for name, kwargs in file_names.items():
+        file_names[name] = os.path.join(SOURCE_PATH, name + ".tif")
+        tifffile.imwrite(file_names[name], data, **kwargs)
+    file_names["png"] = os.path.join(SOURCE_PATH, "image.png")
+    Image.fromarray(data).save(file_names["png"])
+    return file_names
+
+
+def test_region_reads_equal_cropped_images():
+    for file_name in write_images().values():
+        image = image_reader.read_array(file_name, np.uint8, 0)
+        for x_range, y_range in REGIONS:
+            region = image_reader.read_region(file_name, np.uint8, 0, x_range, y_range)
+            assert np.array_equal(
+                region, image[x_range[0] : x_range[1], y_range[0] : y_range[1]]
+            )
+
+            out = np.zeros(
+                (1, x_range[1] - x_range[0], y_range[1] - y_range[0]), np.uint16
+            )
+            dimensions = image_reader.read_array_into(
+                file_name, 0, out, (x_range[0], y_range[0])
+            )
+            assert dimensions == (300, 200)
+            assert np.array_equal(out[0], region[:, :, 0, 0])
+
+
+def test_uncompressed_tiff_stacks_are_memory_mapped():
+    shutil.rmtree(SOURCE_PATH, ignore_errors=True)
+    os.makedirs(SOURCE_PATH)
+    data = np.random.randint(0, 65535, (5, 200, 300), dtype=np.uint16)
+    for byteorder in ["<", ">"]:
+        file_name = os.path.join(SOURCE_PATH, "stack{}.tif".format(byteorder))
+        tifffile.imwrite(file_name, data, byteorder=byteorder)
+        with tifffile.TiffFile(file_name) as tif_file:
+            assert memmap_page(tif_file.pages[2]) is not None
+        for z_slice in range(5):
+            image = image_reader.read_array(file_name, np.uint16, z_slice)
+            assert np.array_equal(image[:, :, 0, 0], data[z_slice].T)
+            for x_range, y_range in REGIONS:
+                region = image_reader.read_region(
+                    file_name, np.uint16, z_slice, x_range, y_range
+                )
+                assert np.array_equal(
+                    region[:, :, 0, 0],
+                    data[z_slice, y_range[0] : y_range[1], x_range[0] : x_range[1]].T,
+                )
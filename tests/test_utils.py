@@ -1,9 +1,18 @@
 import numpy as np
-from wkcuber.utils import get_chunks, get_regular_chunks, BufferedSliceWriter
+from wkcuber.utils import (
+    get_chunks,
+    get_regular_chunks,
+    BufferedSliceWriter,
+    BackgroundWriter,
+    iterate_prefetched,
+    parse_memory_size,
+    morton_code,
+)
 import wkw
 from wkcuber.mag import Mag
 import os
 from shutil import rmtree
+from itertools import product
 
 BLOCK_LEN = 32
 
@@ -38,6 +47,73 @@ def test_get_regular_chunks_max_inclusive():
     assert list(target[-1]) == list(range(44, 45))
 
 
+def test_iterate_prefetched():
+    assert list(iterate_prefetched(pow, [(2, i) for i in range(5)])) == [
+        1,
+        2,
+        4,
+        8,
+        16,
+    ]
+    assert list(iterate_prefetched(pow, [])) == []
+    assert list(iterate_prefetched(pow, [(2, i) for i in range(5)], 3)) == [
+        1,
+        2,
+        4,
+        8,
+        16,
+    ]
+    assert list(iterate_prefetched(pow, [(2, i) for i in range(5)], 0)) == [
+        1,
+        2,
+        4,
+        8,
+        16,
+    ]
+
+
+def test_background_writer():
+    written = []
+    with BackgroundWriter(max_pending_writes=2) as writer:
+        for i in range(10):
+            writer.submit(written.append, i)
+    assert written == list(range(10))
+
+    def failing_write() -> None:
+        raise ValueError("write failed")
+
+    writer = BackgroundWriter()
+    writer.submit(failing_write)
+    try:
+        writer.close()
+        assert False, "The exception of the write should be raised"
+    except ValueError:
+        pass
+
+
+def test_parse_memory_size():
+    assert parse_memory_size("10M") == 10 * 1024 ** 2
+    assert parse_memory_size("4G") == 4 * 1024 ** 3
+    assert parse_memory_size("1.5g") == 1.5 * 1024 ** 3
+    assert parse_memory_size("500") == 500 * 1024 ** 2
+
+
+def test_morton_code():
+    assert morton_code((0, 0, 0)) == 0
+    assert morton_code((1, 0, 0)) == 1
+    assert morton_code((0, 1, 0)) == 2
+    assert morton_code((0, 0, 1)) == 4
+    assert morton_code((2, 0, 0)) == 8
+    assert morton_code((3, 3, 3)) == 63
+
+    # Every aligned 2x2x2 group of cubes is contiguous in morton order
+    addresses = sorted(product(range(4), repeat=3), key=morton_code)
+    for i in range(0, len(addresses), 8):
+        assert (
+            len(set((x // 2, y // 2, z // 2) for x, y, z in addresses[i : i + 8])) == 1
+        )
+
+
 def test_buffered_slice_writer():
     test_img = np.arange(24 * 24).reshape(24, 24).astype(np.uint16) + 1
     dtype = test_img.dtype
@@ -0,0 +1,368 @@
+import time
+import json
+import sys
+import logging
+import tracemalloc
+from argparse import ArgumentParser
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+from .downsampling import (
+    InterpolationModes,
+    downsample_cube,
+    _sort_mode,
+    non_linear_filter_3d,
+)
+from .downsampling_jit import NUMBA_AVAILABLE
+from .utils import add_verbose_flag, setup_logging
+
+DTYPES = ["uint8", "uint16", "uint32", "uint64", "float32"]
+FACTORS = ["2-2-2", "2-2-1", "4-4-4"]
+PATTERNS = ["random", "smooth", "sparse_labels"]
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser()
+
+    parser.add_argument(
+        "--edge_len",
+        help="Edge length of the benchmarked cube (e.g., 256 for a buffer cube of 256^3)",
+        type=int,
+        default=128,
+    )
+
+    parser.add_argument(
+        "--repetitions",
+        "-r",
+        help="Number of repetitions per measurement. The fastest run is reported.",
+        type=int,
+        default=3,
+    )
+
+    parser.add_argument(
+        "--modes",
+        help="Comma-separated interpolation modes of the benchmark suite (default: all)",
+        default=",".join(mode.name.lower() for mode in InterpolationModes),
+    )
+
+    parser.add_argument(
+        "--dtypes",
+        help="Comma-separated dtypes of the benchmark suite",
+        default=",".join(DTYPES),
+    )
+
+    parser.add_argument(
+        "--factors",
+        help="Comma-separated downsampling factors of the benchmark suite",
+        default=",".join(FACTORS),
+    )
+
+    parser.add_argument(
+        "--patterns",
+        help="Comma-separated data patterns of the benchmark suite ({})".format(
+            ", ".join(PATTERNS)
+        ),
+        default=",".join(PATTERNS),
+    )
+
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="Path of the JSON report of the benchmark suite (default: stdout)",
+        default="-",
+    )
+
+    parser.add_argument(
+        "--compare",
+        help="Instead of the benchmark suite, compare the optimized filters with "
+        "their generic implementations.",
+        default=False,
+        action="store_true",
+    )
+
+    add_verbose_flag(parser)
+
+    return parser
+
+
+def create_labels(edge_len: int, dtype: np.dtype) -> np.ndarray:
+    # Segmentation-like data: few distinct labels with large ids,
+    # in fortran order like the buffers returned by wkw
+    labels = np.random.randint(0, 4, (edge_len,) * 3).astype(dtype)
+    labels *= np.iinfo(dtype).max // 4
+    return np.asfortranarray(labels)
+
+
+def create_segmentation(edge_len: int, dtype: np.dtype) -> np.ndarray:
+    # Segmentation-like data: large segments whose borders do not align with
+    # the downsampling blocks, so that most but not all blocks are uniform
+    segment_len = 32
+    segments = np.random.randint(
+        0, 2 ** 16, (max(edge_len // segment_len, 1),) * 3
+    ).astype(dtype)
+    segments *= np.iinfo(dtype).max // 2 ** 16
+    for axis in range(3):
+        segments = np.repeat(segments, segment_len, axis)
+    segments = np.roll(segments[:edge_len, :edge_len, :edge_len], 1, (0, 1, 2))
+    return np.asfortranarray(segments)
+
+
+def create_data(pattern: str, edge_len: int, dtype: np.dtype) -> np.ndarray:
+    shape = (edge_len,) * 3
+    is_float = np.issubdtype(dtype, np.floating)
+    max_value = 1 if is_float else np.iinfo(dtype).max
+    data: np.ndarray
+    if pattern == "random":
+        if is_float:
+            data = np.random.random(shape)
+        else:
+            data = np.random.randint(0, max_value, shape, dtype=dtype)
+    elif pattern == "smooth":
+        # Low-frequency signal like the intensities of EM or light microscopy
+        x, y, z = np.meshgrid(*[np.arange(edge_len)] * 3, indexing="ij", sparse=True)
+        data = (np.sin(x / 16) + np.sin(y / 23) + np.sin(z / 31) + 3) / 6 * max_value
+    elif pattern == "sparse_labels":
+        # Segments of which most belong to the background (0), numbered
+        # consecutively so that the labels fit into every dtype
+        segments = create_segmentation(edge_len, np.dtype("uint32"))
+        labels = np.unique(segments)
+        background = labels[np.random.random(len(labels)) < 0.8]
+        segments[np.isin(segments, background)] = 0
+        data = np.unique(segments, return_inverse=True)[1].reshape(shape)
+    else:
+        raise Exception("Unknown data pattern: {}".format(pattern))
+    return np.asfortranarray(data.astype(dtype))
+
+
+def measure(repetitions: int, func: Callable[..., np.ndarray], *args: Any) -> float:
+    durations = []
+    for _ in range(repetitions):
+        ref_time = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - ref_time)
+    return min(durations)
+
+
+def measure_peak_memory(func: Callable[..., np.ndarray], *args: Any) -> int:
+    # Includes the memory of the result, but not the one of the arguments
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_interpolation_modes(
+    edge_len: int,
+    repetitions: int,
+    interpolation_modes: List[InterpolationModes],
+    dtypes: List[np.dtype],
+    factors_list: List[List[int]],
+    patterns: List[str],
+) -> List[Dict[str, Any]]:
+    results = []
+    voxel_count = edge_len ** 3
+    for pattern in patterns:
+        for dtype in dtypes:
+            data = create_data(pattern, edge_len, dtype)
+            for factors in factors_list:
+                for interpolation_mode in interpolation_modes:
+                    result: Dict[str, Any] = {
+                        "mode": interpolation_mode.name.lower(),
+                        "dtype": dtype.name,
+                        "factors": "-".join(str(factor) for factor in factors),
+                        "pattern": pattern,
+                    }
+                    try:
+                        duration = measure(
+                            repetitions,
+                            downsample_cube,
+                            data,
+                            factors,
+                            interpolation_mode,
+                        )
+                        peak_memory = measure_peak_memory(
+                            downsample_cube, data, factors, interpolation_mode
+                        )
+                        result.update(
+                            {
+                                "seconds": duration,
+                                "voxels_per_second": voxel_count / duration,
+                                "peak_memory_bytes": peak_memory,
+                                "peak_memory_ratio": peak_memory / data.nbytes,
+                            }
+                        )
+                    except Exception as exc:
+                        result["error"] = str(exc)
+                    logging.info(
+                        "{mode} {dtype} {factors} {pattern}: {0}".format(
+                            "{:.1f} MVx/s, peak memory {:.2f}x".format(
+                                result["voxels_per_second"] / 1e6,
+                                result["peak_memory_ratio"],
+                            )
+                            if "error" not in result
+                            else "failed with " + result["error"],
+                            **result,
+                        )
+                    )
+                    results.append(result)
+    return results
+
+
+def sort_mode(votes: List[np.ndarray]) -> np.ndarray:
+    # The generic mode implementation which sorts the votes of every block
+    return _sort_mode(np.stack(votes))
+
+
+def benchmark_mode(edge_len: int, repetitions: int) -> None:
+    dtypes: List[np.dtype] = [np.dtype("uint32"), np.dtype("uint64")]
+    for dtype in dtypes:
+        data = create_labels(edge_len, dtype)
+        for factors in [[2, 2, 2], [2, 2, 1]]:
+            assert np.array_equal(
+                non_linear_filter_3d(data, factors, sort_mode),
+                downsample_cube(data, factors, InterpolationModes.MODE),
+            )
+            generic = measure(
+                repetitions, non_linear_filter_3d, data, factors, sort_mode
+            )
+            fast = measure(
+                repetitions, downsample_cube, data, factors, InterpolationModes.MODE
+            )
+            logging.info(
+                "mode {} {}: generic {:.3f}s, pairwise {:.3f}s, speedup {:.1f}x".format(
+                    dtype.name,
+                    "-".join(str(factor) for factor in factors),
+                    generic,
+                    fast,
+                    generic / fast,
+                )
+            )
+
+
+def benchmark_label_mode(edge_len: int, repetitions: int) -> None:
+    dtypes: List[np.dtype] = [np.dtype("uint32"), np.dtype("uint64")]
+    for dtype in dtypes:
+        for data_name, data in [
+            ("segments", create_segmentation(edge_len, dtype)),
+            ("noise", create_labels(edge_len, dtype)),
+        ]:
+            for factors in [[2, 2, 2], [2, 2, 1], [4, 4, 4]]:
+                assert np.array_equal(
+                    downsample_cube(data, factors, InterpolationModes.MODE),
+                    downsample_cube(data, factors, InterpolationModes.LABEL_MODE),
+                )
+                durations = [
+                    measure(
+                        repetitions, downsample_cube, data, factors, interpolation_mode
+                    )
+                    for interpolation_mode in [
+                        InterpolationModes.MODE,
+                        InterpolationModes.LABEL_MODE,
+                    ]
+                ]
+                logging.info(
+                    "label mode {} {} {}: mode {:.3f}s, label {:.3f}s, speedup {:.1f}x".format(
+                        dtype.name,
+                        data_name,
+                        "-".join(str(factor) for factor in factors),
+                        *durations,
+                        durations[0] / durations[1],
+                    )
+                )
+
+
+def float_median(votes: List[np.ndarray]) -> np.ndarray:
+    # The former median implementation which computes the median as float
+    return np.median(np.stack(votes), axis=0).astype(votes[0].dtype)
+
+
+def benchmark_median(edge_len: int, repetitions: int) -> None:
+    dtypes: List[np.dtype] = [np.dtype("uint8"), np.dtype("uint16")]
+    for dtype in dtypes:
+        data = np.asfortranarray(
+            np.random.randint(0, np.iinfo(dtype).max, (edge_len,) * 3).astype(dtype)
+        )
+        for factors in [[2, 2, 2], [2, 2, 1]]:
+            float_duration = measure(
+                repetitions, non_linear_filter_3d, data, factors, float_median
+            )
+            integer_duration = measure(
+                repetitions, downsample_cube, data, factors, InterpolationModes.MEDIAN
+            )
+            logging.info(
+                "median {} {}: float {:.3f}s, integer {:.3f}s, speedup {:.1f}x".format(
+                    dtype.name,
+                    "-".join(str(factor) for factor in factors),
+                    float_duration,
+                    integer_duration,
+                    float_duration / integer_duration,
+                )
+            )
+
+
+def benchmark_average(edge_len: int, repetitions: int) -> None:
+    dtypes: List[np.dtype] = [np.dtype("uint8"), np.dtype("uint16")]
+    for dtype in dtypes:
+        data = np.asfortranarray(
+            np.random.randint(0, np.iinfo(dtype).max, (edge_len,) * 3).astype(dtype)
+        )
+        factors = [2, 2, 2]
+        durations = [
+            measure(repetitions, downsample_cube, data, factors, interpolation_mode)
+            for interpolation_mode in [
+                InterpolationModes.BILINEAR,
+                InterpolationModes.MEDIAN,
+                InterpolationModes.AVERAGE,
+            ]
+        ]
+        logging.info(
+            "average {} {}: bilinear {:.3f}s, median {:.3f}s, average {:.3f}s".format(
+                dtype.name, "-".join(str(factor) for factor in factors), *durations
+            )
+        )
+
+
+def benchmark_downsampling(edge_len: int, repetitions: int) -> None:
+    benchmark_functions: List[Callable[[int, int], None]] = [
+        benchmark_mode,
+        benchmark_label_mode,
+        benchmark_median,
+        benchmark_average,
+    ]
+    for benchmark_function in benchmark_functions:
+        benchmark_function(edge_len, repetitions)
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    setup_logging(args)
+
+    if args.compare:
+        benchmark_downsampling(args.edge_len, args.repetitions)
+    else:
+        results = benchmark_interpolation_modes(
+            args.edge_len,
+            args.repetitions,
+            [InterpolationModes[mode.upper()] for mode in args.modes.split(",")],
+            [np.dtype(dtype) for dtype in args.dtypes.split(",")],
+            [
+                [int(factor) for factor in factors.split("-")]
+                for factors in args.factors.split(",")
+            ],
+            args.patterns.split(","),
+        )
+        report = {
+            "edge_len": args.edge_len,
+            "repetitions": args.repetitions,
+            "numpy_version": np.__version__,
+            "numba_available": NUMBA_AVAILABLE,
+            "results": results,
+        }
+        if args.output == "-":
+            json.dump(report, sys.stdout, indent=2)
+        else:
+            with open(args.output, "w") as report_file:
+                json.dump(report, report_file, indent=2)
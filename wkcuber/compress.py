@@ -15,6 +15,8 @@ from .utils import (
     get_executor_for_args,
     wait_and_ensure_success,
     setup_logging,
+    parse_cube_file_name,
+    morton_code,
 )
 from .metadata import detect_resolutions, convert_element_class_to_dtype
 from typing import List, Tuple
@@ -98,7 +100,11 @@ def compress_mag(
         source_wkw.compress(target_mag_path)
         with get_executor_for_args(args) as executor:
             job_args = []
-            for file in source_wkw.list_files():
+            files = sorted(
+                source_wkw.list_files(),
+                key=lambda file: morton_code(parse_cube_file_name(file)),
+            )
+            for file in files:
                 rel_file = path.relpath(file, source_wkw.root)
                 job_args.append((file, path.join(target_mag_path, rel_file)))
 
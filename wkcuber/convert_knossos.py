@@ -16,6 +16,7 @@ from .utils import (
     get_executor_for_args,
     wait_and_ensure_success,
     setup_logging,
+    morton_code,
 )
 from .knossos import CUBE_EDGE_LEN
 from .metadata import convert_element_class_to_dtype
@@ -97,7 +98,7 @@ def convert_knossos(
                 logging.error("No input KNOSSOS cubes found.")
                 exit(1)
 
-            knossos_cubes.sort()
+            knossos_cubes.sort(key=morton_code)
             job_args = []
             for cube_xyz in knossos_cubes:
                 job_args.append((cube_xyz, source_knossos_info, target_wkw_info))
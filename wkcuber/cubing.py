@@ -1,17 +1,19 @@
 import time
 import logging
-from typing import List, Tuple
+import math
+from typing import List, Optional, Tuple
 
 import numpy as np
 import wkw
 from argparse import ArgumentParser, Namespace
 from os import path
+from concurrent.futures import ThreadPoolExecutor
 from natsort import natsorted
 
 from .mag import Mag
 from .downsampling import (
     parse_interpolation_mode,
-    downsample_unpadded_data,
+    downsample_cube,
     InterpolationModes,
 )
 from .utils import (
@@ -27,11 +29,16 @@ from .utils import (
     get_executor_for_args,
     wait_and_ensure_success,
     setup_logging,
+    BackgroundWriter,
 )
 from .image_readers import image_reader
 from .metadata import convert_element_class_to_dtype
 
 BLOCK_LEN = 32
+DEFAULT_PREFETCH_SLICES = 4
+# Sections are split into columns if the batch buffers of whole sections exceeded
+# this size (in bytes)
+MAX_BATCH_BUFFER_SIZE = 1024 ** 3
 
 
 def create_parser() -> ArgumentParser:
@@ -87,6 +94,26 @@ def create_parser() -> ArgumentParser:
         default="1",
     )
 
+    parser.add_argument(
+        "--prefetch_slices",
+        help="Number of threads per job which read and decode the image files of a "
+        "batch in parallel, directly into the batch buffer. Use 0 to read the images "
+        "one after another.",
+        default=DEFAULT_PREFETCH_SLICES,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--column_size",
+        help="Edge length (in mag 1 voxels) of the XY columns which are cubed by "
+        "separate jobs, rounded up to whole wkw files of the target magnification. "
+        "Every job only buffers its column of the sections, so that the memory does "
+        "not depend on the size of the sections. By default, sections are only split "
+        "into columns if a batch of whole sections needs more than 1 GB of memory.",
+        default=None,
+        type=int,
+    )
+
     add_interpolation_flag(parser)
     add_verbose_flag(parser)
     add_distribution_flags(parser)
@@ -117,6 +144,16 @@ def read_image_file(file_name: str, dtype: type, z_slice: int) -> np.ndarray:
         raise exc
 
 
+def read_image_file_into(
+    file_name: str, z_slice: int, out: np.ndarray, offset: Tuple[int, int]
+) -> Tuple[int, int]:
+    try:
+        return image_reader.read_array_into(file_name, z_slice, out, offset)
+    except Exception as exc:
+        logging.error("Reading of file={} failed with {}".format(file_name, exc))
+        raise exc
+
+
 def prepare_slices_for_wkw(
     slices: List[np.ndarray], num_channels: int = None
 ) -> np.ndarray:
@@ -143,6 +180,9 @@ def cubing_job(
         int,
         Tuple[int, int],
         bool,
+        int,
+        Tuple[int, int],
+        Tuple[int, int],
     ]
 ) -> None:
     (
@@ -154,13 +194,28 @@ def cubing_job(
         batch_size,
         image_size,
         pad,
+        prefetch_slices,
+        column_offset,
+        column_size,
     ) = args
     if len(z_batches) == 0:
         return
 
     downsampling_needed = target_mag != Mag(1)
-
-    with open_wkw(target_wkw_info) as target_wkw:
+    mag_factors = target_mag.to_array()
+    num_channels = target_wkw_info.header.num_channels
+    # A batch is written in the background while the next one is read into the
+    # other pair of buffers. The buffers are reused by the following batches if
+    # their shape matches.
+    batch_buffers = [np.empty((0,) * 4)] * 2
+    downsampled_buffers: List[Optional[np.ndarray]] = [None] * 2
+    buffer_index = 0
+
+    # The sections of a batch are read and decoded by a pool of threads (which
+    # are only started on demand)
+    with open_wkw(target_wkw_info) as target_wkw, ThreadPoolExecutor(
+        max_workers=max(prefetch_slices, 1)
+    ) as read_executor, BackgroundWriter() as writer:
         # Iterate over batches of continuous z sections
         # The batches have a maximum size of `batch_size`
         # Batched iterations allows to utilize IO more efficiently
@@ -170,50 +225,123 @@ def cubing_job(
         ):
             try:
                 ref_time = time.time()
-                logging.info("Cubing z={}-{}".format(z_batch[0], z_batch[-1]))
-                slices = []
-                # Iterate over each z section in the batch
-                for z, file_name in zip(z_batch, source_file_batch):
-                    # Image shape will be (x, y, channel_count, z=1)
-                    image = read_image_file(
-                        file_name, target_wkw_info.header.voxel_type, z
+                logging.info(
+                    "Cubing z={}-{} at x={} y={}".format(
+                        z_batch[0], z_batch[-1], *column_offset
                     )
+                )
 
-                    if not pad:
-                        assert (
-                            image.shape[0:2] == image_size
-                        ), "Section z={} has the wrong dimensions: {} (expected {}). Consider using --pad.".format(
-                            z, image.shape, image_size
-                        )
-                    slices.append(image)
-
+                # The regions of the sections within the column
                 if pad:
-                    x_max = max(_slice.shape[0] for _slice in slices)
-                    y_max = max(_slice.shape[1] for _slice in slices)
-
-                    slices = [
-                        np.pad(
-                            _slice,
-                            mode="constant",
-                            pad_width=[
-                                (0, x_max - _slice.shape[0]),
-                                (0, y_max - _slice.shape[1]),
-                                (0, 0),
-                                (0, 0),
-                            ],
+                    regions = [
+                        tuple(
+                            max(0, min(size - offset, column_len))
+                            for size, offset, column_len in zip(
+                                image_reader.read_dimensions(file_name),
+                                column_offset,
+                                column_size,
+                            )
                         )
-                        for _slice in slices
+                        for file_name in source_file_batch
                     ]
-
-                buffer = prepare_slices_for_wkw(
-                    slices, target_wkw_info.header.num_channels
+                    x_max = max(x for x, _ in regions)
+                    y_max = max(y for _, y in regions)
+                    if x_max == 0 or y_max == 0:
+                        # All sections of the batch end before the column
+                        continue
+                else:
+                    regions = [column_size] * len(source_file_batch)
+                    x_max, y_max = column_size
+                # The batch buffer has the shape (channel_count, x, y, z) which
+                # wkw expects. It is padded to a multiple of the target mag, so
+                # that it can be downsampled without another copy.
+                batch_shape = (num_channels,) + tuple(
+                    -(-size // factor) * factor
+                    for size, factor in zip((x_max, y_max, len(z_batch)), mag_factors)
                 )
-                if downsampling_needed:
-                    buffer = downsample_unpadded_data(
-                        buffer, target_mag, interpolation_mode
+                # The previous batch in these buffers was written before the
+                # last batch was submitted to the writer
+                batch_buffer = batch_buffers[buffer_index]
+                if batch_buffer.shape != batch_shape:
+                    batch_buffer = np.zeros(
+                        batch_shape, dtype=target_wkw_info.header.voxel_type, order="F"
+                    )
+                    batch_buffers[buffer_index] = batch_buffer
+
+                # Every section is decoded directly into its slot of the batch
+                # buffer, which has the shape (channel_count, x, y)
+                read_args = []
+                for z_index, (z, file_name, (x, y)) in enumerate(
+                    zip(z_batch, source_file_batch, regions)
+                ):
+                    if pad:
+                        # Clear the padding, which may hold a larger section of
+                        # a previous batch
+                        batch_buffer[:, x:, :, z_index] = 0
+                        batch_buffer[:, :x, y:, z_index] = 0
+                        if x == 0 or y == 0:
+                            continue
+                    read_args.append(
+                        (file_name, z, batch_buffer[:, :x, :y, z_index], column_offset)
+                    )
+                if prefetch_slices == 0:
+                    dimensions = [
+                        read_image_file_into(*read_arg) for read_arg in read_args
+                    ]
+                else:
+                    dimensions = wait_and_ensure_success(
+                        [
+                            read_executor.submit(read_image_file_into, *read_arg)
+                            for read_arg in read_args
+                        ]
                     )
+                if not pad:
+                    for z, section_size in zip(z_batch, dimensions):
+                        assert (
+                            section_size == image_size
+                        ), "Section z={} has the wrong dimensions: {} (expected {}). Consider using --pad.".format(
+                            z, section_size, image_size
+                        )
 
-                target_wkw.write([0, 0, z_batch[0] / target_mag.to_array()[2]], buffer)
+                buffer = batch_buffer
+                if downsampling_needed:
+                    downsampled_shape = (num_channels,) + tuple(
+                        size // factor
+                        for size, factor in zip(batch_shape[1:], mag_factors)
+                    )
+                    downsampled_buffer = downsampled_buffers[buffer_index]
+                    if (
+                        downsampled_buffer is None
+                        or downsampled_buffer.shape != downsampled_shape
+                    ):
+                        downsampled_buffer = np.empty(
+                            downsampled_shape, dtype=batch_buffer.dtype, order="F"
+                        )
+                        downsampled_buffers[buffer_index] = downsampled_buffer
+                    logging.info(
+                        f"Downsampling buffer of size {batch_shape} to mag {target_mag.to_layer_name()}"
+                    )
+                    buffer = downsample_cube(
+                        batch_buffer,
+                        mag_factors,
+                        interpolation_mode,
+                        out=downsampled_buffer,
+                    )
+                else:
+                    # Without downsampling, nothing is padded and the buffer
+                    # holds exactly the sections of the batch
+                    buffer = batch_buffer[:, :x_max, :y_max, : len(z_batch)]
+
+                writer.submit(
+                    target_wkw.write,
+                    [
+                        column_offset[0] // mag_factors[0],
+                        column_offset[1] // mag_factors[1],
+                        z_batch[0] / mag_factors[2],
+                    ],
+                    buffer,
+                )
+                buffer_index = 1 - buffer_index
                 logging.debug(
                     "Cubing of z={}-{} took {:.8f}s".format(
                         z_batch[0], z_batch[-1], time.time() - ref_time
@@ -229,6 +357,52 @@ def cubing_job(
                 raise exc
 
 
+def determine_column_size(
+    section_size: Tuple[int, int],
+    target_wkw_info: WkwDatasetInfo,
+    target_mag: Mag,
+    batch_size: int,
+    column_size: Optional[int] = None,
+) -> Tuple[int, int]:
+    """
+    Returns the size (in mag 1 voxels) of the XY columns which are cubed by
+    separate jobs. The columns are aligned with the wkw files of the target
+    mag. Unless column_size is given, the sections are only split if the two
+    batch buffers of a job (see cubing_job) exceeded MAX_BATCH_BUFFER_SIZE.
+    """
+    header = target_wkw_info.header
+    file_size = [
+        header.file_len * BLOCK_LEN * factor for factor in target_mag.to_array()[0:2]
+    ]
+    if column_size is None:
+        voxel_size = header.num_channels * np.dtype(header.voxel_type).itemsize
+        batch_voxel_size = 2 * voxel_size * min(batch_size, BLOCK_LEN)
+        if (
+            section_size[0] * section_size[1] * batch_voxel_size
+            <= MAX_BATCH_BUFFER_SIZE
+        ):
+            return section_size
+        # The largest square of files which fits into the batch buffer
+        file_counts = [
+            max(
+                1,
+                int(
+                    math.sqrt(
+                        MAX_BATCH_BUFFER_SIZE
+                        / (batch_voxel_size * file_size[0] * file_size[1])
+                    )
+                ),
+            )
+        ] * 2
+    else:
+        file_counts = [-(-column_size // size) for size in file_size]
+    x, y = (
+        min(section_len, file_count * size)
+        for section_len, file_count, size in zip(section_size, file_counts, file_size)
+    )
+    return x, y
+
+
 def cubing(
     source_path: str,
     target_path: str,
@@ -239,7 +413,8 @@ def cubing(
 ) -> dict:
     source_files = find_source_filenames(source_path)
 
-    # All images are assumed to have equal dimensions
+    # All images are assumed to have equal dimensions (or to be padded to the
+    # largest ones)
     num_x, num_y = image_reader.read_dimensions(source_files[0])
     num_channels = image_reader.read_channel_count(source_files[0])
     num_z_slices_per_file = image_reader.read_z_slices_per_file(source_files[0])
@@ -274,6 +449,22 @@ def cubing(
 
     ensure_wkw(target_wkw_info)
 
+    section_size = (num_x, num_y)
+    if args.pad:
+        dimensions = [
+            image_reader.read_dimensions(file_name) for file_name in source_files
+        ]
+        section_size = (max(x for x, _ in dimensions), max(y for _, y in dimensions))
+    column_width, column_height = determine_column_size(
+        section_size, target_wkw_info, target_mag, batch_size, args.column_size
+    )
+    if (column_width, column_height) != section_size:
+        logging.info(
+            "Cubing the sections in columns of {}x{}".format(
+                column_width, column_height
+            )
+        )
+
     start_z = args.start_z
 
     with get_executor_for_args(args) as executor:
@@ -288,19 +479,27 @@ def cubing(
                 source_files_array = source_files[z - start_z : max_z - start_z]
             else:
                 source_files_array = source_files * (max_z - z)
-            # Prepare job
-            job_args.append(
-                (
-                    target_wkw_info,
-                    z_batch,
-                    target_mag,
-                    interpolation_mode,
-                    source_files_array,
-                    batch_size,
-                    (num_x, num_y),
-                    args.pad,
-                )
-            )
+            # Prepare one job per column
+            for column_x in range(0, section_size[0], column_width):
+                for column_y in range(0, section_size[1], column_height):
+                    job_args.append(
+                        (
+                            target_wkw_info,
+                            z_batch,
+                            target_mag,
+                            interpolation_mode,
+                            source_files_array,
+                            batch_size,
+                            (num_x, num_y),
+                            args.pad,
+                            args.prefetch_slices,
+                            (column_x, column_y),
+                            (
+                                min(column_width, section_size[0] - column_x),
+                                min(column_height, section_size[1] - column_y),
+                            ),
+                        )
+                    )
 
         wait_and_ensure_success(executor.map_to_futures(cubing_job, job_args))
 
@@ -1,16 +1,34 @@
 import logging
 import math
-from typing import Any, Tuple, Callable, List, cast
+from typing import (
+    Any,
+    Tuple,
+    Callable,
+    List,
+    Dict,
+    Set,
+    Optional,
+    Iterator,
+    NamedTuple,
+    cast,
+)
 
 import wkw
 import numpy as np
 from argparse import ArgumentParser, Namespace
 import os
-from scipy.ndimage.interpolation import zoom
+import json
+import hashlib
+import psutil
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from scipy.ndimage import spline_filter1d
+from numpy.lib.stride_tricks import as_strided
 from itertools import product
 from enum import Enum
+from .api.bounding_box import BoundingBox
 from .mag import Mag
 from .metadata import read_datasource_properties, refresh_metadata
+from .downsampling_jit import downsample_cube_jit
 
 from .utils import (
     add_verbose_flag,
@@ -26,13 +44,236 @@ from .utils import (
     add_isotropic_flag,
     setup_logging,
     cube_addresses,
+    get_chunks,
+    cube_file_path,
+    iterate_prefetched,
+    parse_bounding_box,
+    parse_cube_address,
+    bounding_box_cube_addresses,
+    BackgroundWriter,
+    get_memory_per_job,
+    get_job_count,
+    with_job_count,
+    morton_code,
 )
 
 DEFAULT_EDGE_LEN = 256
+# Up to this number of voxels per block (e.g., 2-2-2), the mode and the median
+# are computed element-wise on the votes instead of sorting the block matrix
+SMALL_BLOCK_MAX_VOTES = 8
+# Above this ratio of blocks with more than one label, LABEL_MODE falls back to
+# the regular mode filter
+LABEL_MODE_MAX_MIXED_RATIO = 0.5
+# Interpolation modes which have a JIT-compiled kernel (if numba is installed).
+# The mode kernel is faster than _label_mode, too, even on segmentation data.
+JIT_KERNEL_NAMES = {
+    "MODE": "mode",
+    "LABEL_MODE": "mode",
+    "MEDIAN": "median",
+    "AVERAGE": "average",
+}
+# Padding of the data before computing the spline coefficients, so that the
+# boundary condition of the spline filter does not matter (as in scipy.ndimage)
+SPLINE_PADDING = 12
+# Number of output rows along the outermost axis which the linear modes
+# interpolate at once
+LINEAR_FILTER_SLAB_LEN = 8
+# Every job holds the source tile which is downsampled, the prefetched one and
+# the temporaries of the filters, which are at most about two source tiles
+SOURCE_TILES_PER_JOB = 4
+# Share of the available memory which is planned for the downsampling jobs
+MEMORY_USAGE_RATIO = 0.8
+# By default, small target cubes are grouped into jobs of about this many voxels
+TARGET_VOXELS_PER_JOB = 1024 ** 3
+JOURNAL_FILE_NAME = "downsampling.journal"
+
+
+class DownsamplingPlan(NamedTuple):
+    buffer_edge_len: int
+    # None if the number of jobs is not limited by the plan (e.g., for slurm)
+    jobs: Optional[int]
+    memory_per_job: int
+
+
+class DownsamplingJournal(object):
+    """
+    Journal of the finished target cubes of a downsampling run, which is stored in
+    the target mag directory. The first line describes the run (source mag,
+    interpolation mode, ...), every following line contains a finished target
+    cube and the result of its job. A restarted run with the same description
+    skips the journaled cubes. The journal is removed once the run has finished.
+    """
+
+    def __init__(self, target_wkw_info: WkwDatasetInfo, description: Dict[str, Any]):
+        self.path = os.path.join(
+            target_wkw_info.dataset_path,
+            target_wkw_info.layer_name,
+            str(target_wkw_info.mag),
+            JOURNAL_FILE_NAME,
+        )
+        self.description = description
+        self.file: Optional[Any] = None
+
+    def load(self) -> Dict[Tuple[int, int, int], Any]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as journal_file:
+            lines = journal_file.read().splitlines()
+        try:
+            description = json.loads(lines[0]) if len(lines) > 0 else None
+        except ValueError:
+            description = None
+        if description != self.description:
+            logging.warning(
+                "Ignoring the journal {} of a different downsampling run".format(
+                    self.path
+                )
+            )
+            return {}
+        results = {}
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may be incomplete if the run was killed
+                break
+            results[cast(Tuple[int, int, int], tuple(entry["cube"]))] = entry["result"]
+        return results
+
+    def start(self) -> Dict[Tuple[int, int, int], Any]:
+        """
+        Returns the results of the already finished cubes and (re)writes the
+        journal with them, so that new results can be appended.
+        """
+        results = self.load()
+        if len(results) > 0:
+            logging.info(
+                "Resuming from {}: {} target cubes are already finished".format(
+                    self.path, len(results)
+                )
+            )
+        self.file = open(self.path, "w")
+        self.file.write(json.dumps(self.description) + "\n")
+        for cube_xyz, result in results.items():
+            self.file.write(json.dumps({"cube": cube_xyz, "result": result}) + "\n")
+        self.flush()
+        return results
+
+    def record(self, cube_xyz: Tuple[int, int, int], result: Any) -> None:
+        assert self.file is not None, "The journal has not been started"
+        self.file.write(json.dumps({"cube": cube_xyz, "result": result}) + "\n")
+
+    def flush(self) -> None:
+        assert self.file is not None, "The journal has not been started"
+        self.file.flush()
+        # The journal needs to survive node failures, not only process failures
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def remove(self) -> None:
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def estimate_memory_per_job(
+    header: wkw.Header, mag_factors_per_level: List[List[int]], buffer_edge_len: int
+) -> int:
+    """
+    Estimates the peak memory of a downsampling job which computes one cube per
+    level: the target cube buffers (plus one which is being written), the source
+    tiles of the first level and, for every fused level above it, the filter
+    temporaries of downsampling a whole cube of the level below at once.
+    """
+    wkw_cubelength = header.file_len * header.block_len
+    voxel_size = header.num_channels * np.dtype(header.voxel_type).itemsize
+    cube_size = voxel_size * wkw_cubelength ** 3
+    source_tile_size = voxel_size * buffer_edge_len ** 3
+    for mag_factor in mag_factors_per_level[0]:
+        source_tile_size *= mag_factor
+    level_count = len(mag_factors_per_level)
+    fused_level_count = level_count - 1
+    return (
+        level_count + 1 + fused_level_count
+    ) * cube_size + SOURCE_TILES_PER_JOB * source_tile_size
+
+
+def plan_downsampling(
+    header: wkw.Header,
+    mag_factors_per_level: List[List[int]],
+    buffer_edge_len: Optional[int] = None,
+    args: Optional[Namespace] = None,
+) -> DownsamplingPlan:
+    """
+    Picks the largest buffer edge length (unless it is given) and the number of
+    parallel jobs, so that the jobs fit into the available memory. For slurm, the
+    memory of a single job is limited by the "mem" of --job_resources instead.
+    """
+    wkw_cubelength = header.file_len * header.block_len
+    if buffer_edge_len is None:
+        max_edge_len = min(DEFAULT_EDGE_LEN, wkw_cubelength)
+        candidates = [
+            edge_len
+            for edge_len in (
+                max_edge_len >> shift for shift in range(max_edge_len.bit_length())
+            )
+            if edge_len >= header.block_len and wkw_cubelength % edge_len == 0
+        ]
+    else:
+        candidates = [buffer_edge_len]
+
+    def memory_per_job(edge_len: int) -> int:
+        return estimate_memory_per_job(header, mag_factors_per_level, edge_len)
+
+    memory_limit = get_memory_per_job(args)
+    if memory_limit is not None:
+        jobs = None
+        memory_per_job_limit = memory_limit
+        available_memory = memory_limit
+    else:
+        jobs = get_job_count(args)
+        available_memory = int(psutil.virtual_memory().available * MEMORY_USAGE_RATIO)
+        memory_per_job_limit = available_memory // jobs
+
+    fitting_candidates = [
+        edge_len
+        for edge_len in candidates
+        if memory_per_job(edge_len) <= memory_per_job_limit
+    ]
+    plan_edge_len = fitting_candidates[0] if fitting_candidates else candidates[-1]
+    plan_memory_per_job = memory_per_job(plan_edge_len)
+    if jobs is not None and plan_memory_per_job * jobs > available_memory:
+        jobs = max(1, available_memory // plan_memory_per_job)
+    if plan_memory_per_job > available_memory:
+        logging.warning(
+            "A single downsampling job needs about {:.2f} GB, but only {:.2f} GB are available".format(
+                plan_memory_per_job / 1024 ** 3, available_memory / 1024 ** 3
+            )
+        )
+
+    logging.info(
+        "Downsampling plan: buffer cube size {}, {} parallel jobs, about {:.2f} GB per job ({:.2f} GB available)".format(
+            plan_edge_len,
+            "unlimited" if jobs is None else jobs,
+            plan_memory_per_job / 1024 ** 3,
+            available_memory / 1024 ** 3,
+        )
+    )
+    return DownsamplingPlan(plan_edge_len, jobs, plan_memory_per_job)
 
 
-def determine_buffer_edge_len(dataset: wkw.Dataset) -> int:
-    return min(DEFAULT_EDGE_LEN, dataset.header.file_len * dataset.header.block_len)
+def apply_downsampling_plan(
+    plan: DownsamplingPlan, args: Optional[Namespace]
+) -> Optional[Namespace]:
+    """Returns the args with the number of jobs of the plan (if it limits them)."""
+    if plan.jobs is None or plan.jobs >= get_job_count(args):
+        return args
+    return with_job_count(args, plan.jobs)
 
 
 def extend_wkw_dataset_info_header(wkw_info: WkwDatasetInfo, **kwargs: Any) -> None:
@@ -60,6 +301,8 @@ class InterpolationModes(Enum):
     BICUBIC = 4
     MAX = 5
     MIN = 6
+    AVERAGE = 7
+    LABEL_MODE = 8
 
 
 def create_parser() -> ArgumentParser:
@@ -108,7 +351,9 @@ def create_parser() -> ArgumentParser:
     parser.add_argument(
         "--buffer_cube_size",
         "-b",
-        help="Size of buffered cube to be downsampled (i.e. buffer cube edge length)",
+        help="Size of buffered cube to be downsampled (i.e. buffer cube edge length). "
+        "By default, the largest size (up to 256) for which all jobs fit into the available "
+        "memory is chosen and the number of jobs is reduced if necessary.",
         type=int,
         default=None,
     )
@@ -120,6 +365,55 @@ def create_parser() -> ArgumentParser:
         action="store_true",
     )
 
+    parser.add_argument(
+        "--mags_per_job",
+        help="Number of magnifications which are computed in a single pass. Each job reads "
+        "its source region only once and derives all of these magnifications from memory, "
+        "instead of reading every intermediate magnification from disk again. Each "
+        "additional magnification needs memory for one more cube buffer per job and reduces "
+        "the number of jobs by the downsampling factor.",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--dirty_bbox",
+        help="Only recompute the cubes of the target magnifications which are affected by "
+        "changes within this bounding box (in mag 1 coordinates, e.g., 0,0,0,1024,1024,512).",
+        type=parse_bounding_box,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--bbox",
+        help="Only downsample the cubes of the target magnifications which intersect this "
+        "bounding box (in mag 1 coordinates, e.g., 0,0,0,1024,1024,512), e.g., to review "
+        "a region of interest quickly.",
+        type=parse_bounding_box,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--dirty_cube",
+        help="Only recompute the cubes of the target magnifications which are affected by "
+        "changes of this wkw cube of the source magnification (e.g., 0,0,0). Can be "
+        "passed multiple times.",
+        type=parse_cube_address,
+        action="append",
+        dest="dirty_cubes",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--cubes_per_job",
+        help="Number of target cubes which are downsampled by a single job. By default, "
+        "small cubes are grouped into jobs of about one gigavoxel, as long as there are "
+        "enough jobs for all workers. Larger groups reduce the scheduling overhead (e.g., "
+        "of slurm) for many small cubes.",
+        type=int,
+        default=None,
+    )
+
     add_interpolation_flag(parser)
     add_verbose_flag(parser)
     add_isotropic_flag(parser)
@@ -128,6 +422,106 @@ def create_parser() -> ArgumentParser:
     return parser
 
 
+def get_target_cube_address(
+    source_cube_xyz: Tuple[int, int, int], mag_factors: List[int]
+) -> Tuple[int, int, int]:
+    return cast(
+        Tuple[int, int, int],
+        tuple(c // f for c, f in zip(source_cube_xyz, mag_factors)),
+    )
+
+
+def get_target_cube_addresses(
+    source_cube_addresses: List[Tuple[int, int, int]], mag_factors: List[int]
+) -> List[Tuple[int, int, int]]:
+    """
+    Returns the addresses of the target cubes which the source cubes belong to
+    in morton order.
+    """
+    return sorted(
+        set(get_target_cube_address(xyz, mag_factors) for xyz in source_cube_addresses),
+        key=morton_code,
+    )
+
+
+def get_bounding_box_cube_addresses(
+    source_wkw_info: WkwDatasetInfo, source_mag: Mag, bbox: BoundingBox
+) -> Set[Tuple[int, int, int]]:
+    """
+    Returns the addresses of all cubes of source_mag which intersect the bounding
+    box (in mag 1 coordinates), whether they exist or not.
+    """
+    with open_wkw(source_wkw_info) as source_wkw:
+        return set(
+            bounding_box_cube_addresses(
+                source_wkw, bbox.align_with_mag(source_mag, True).in_mag(source_mag)
+            )
+        )
+
+
+def create_target_wkw(
+    source_wkw_info: WkwDatasetInfo, target_wkw_info: WkwDatasetInfo, compress: bool
+) -> None:
+    """Creates the target dataset with the channels and file_len of the source."""
+    with open_wkw(source_wkw_info) as source_wkw:
+        header_block_type = (
+            wkw.Header.BLOCK_TYPE_LZ4HC if compress else wkw.Header.BLOCK_TYPE_RAW
+        )
+
+        extend_wkw_dataset_info_header(
+            target_wkw_info,
+            num_channels=source_wkw.header.num_channels,
+            file_len=source_wkw.header.file_len,
+            block_type=header_block_type,
+        )
+
+        ensure_wkw(target_wkw_info)
+
+
+def create_downsampling_journal(
+    target_wkw_info: WkwDatasetInfo,
+    source_mag: Mag,
+    target_mag: Mag,
+    interpolation_mode: InterpolationModes,
+    compress: bool,
+    selection: Optional[Dict[str, Any]] = None,
+) -> DownsamplingJournal:
+    description: Dict[str, Any] = {
+        "source_mag": source_mag.to_layer_name(),
+        "target_mag": target_mag.to_layer_name(),
+        "interpolation_mode": interpolation_mode.name,
+        "compress": compress,
+    }
+    if selection is not None:
+        description["selection"] = selection
+    return DownsamplingJournal(target_wkw_info, description)
+
+
+def describe_cube_selection(
+    dirty_cube_addresses: Optional[List[Tuple[int, int, int]]],
+    bbox: Optional[BoundingBox],
+) -> Optional[Dict[str, Any]]:
+    """
+    Describes the cubes which a partial run (dirty cubes or a bounding box)
+    recomputes for the journal, so that a run never skips cubes which were
+    journaled by a run of other cubes. The dirty cubes are only stored as a
+    digest. Returns None for full runs.
+    """
+    if dirty_cube_addresses is None and bbox is None:
+        return None
+    dirty_cubes_digest = None
+    if dirty_cube_addresses is not None:
+        dirty_cubes_digest = hashlib.sha1(
+            json.dumps(
+                [[int(dim) for dim in xyz] for xyz in sorted(dirty_cube_addresses)]
+            ).encode()
+        ).hexdigest()
+    return {
+        "dirty_cubes": dirty_cubes_digest,
+        "bbox": None if bbox is None else bbox.as_csv(),
+    }
+
+
 def downsample(
     source_wkw_info: WkwDatasetInfo,
     target_wkw_info: WkwDatasetInfo,
@@ -137,7 +531,19 @@ def downsample(
     compress: bool,
     buffer_edge_len: int = None,
     args: Namespace = None,
-) -> None:
+    source_cube_addresses: List[Tuple[int, int, int]] = None,
+    keep_journal: bool = False,
+    selection: Dict[str, Any] = None,
+) -> List[Tuple[int, int, int]]:
+    """
+    Downsamples source_mag to target_mag and returns the addresses of the target
+    cubes which contain data. Empty target cubes are not written at all.
+    If source_cube_addresses is passed (e.g., the result of downsampling the
+    previous mag), only these source cubes are considered instead of all files.
+    Finished cubes are recorded in a DownsamplingJournal, so that an interrupted
+    run can be resumed. The journal is removed at the end unless keep_journal is set.
+    The selection of a partial run (see describe_cube_selection) is journaled too.
+    """
 
     assert source_mag < target_mag
     logging.info("Downsampling mag {} from mag {}".format(target_mag, source_mag))
@@ -146,18 +552,21 @@ def downsample(
         t // s for (t, s) in zip(target_mag.to_array(), source_mag.to_array())
     ]
     # Detect the cubes that we want to downsample
-    source_cube_addresses = cube_addresses(source_wkw_info)
-
-    target_cube_addresses = list(
-        set(
-            tuple(dim // mag_factor for (dim, mag_factor) in zip(xyz, mag_factors))
-            for xyz in source_cube_addresses
-        )
+    if source_cube_addresses is None:
+        source_cube_addresses = cube_addresses(source_wkw_info)
+    if len(source_cube_addresses) == 0:
+        logging.info("Mag {} is empty, skipping mag {}".format(source_mag, target_mag))
+        return []
+
+    target_cube_addresses = get_target_cube_addresses(
+        source_cube_addresses, mag_factors
     )
-    target_cube_addresses.sort()
     with open_wkw(source_wkw_info) as source_wkw:
-        if buffer_edge_len is None:
-            buffer_edge_len = determine_buffer_edge_len(source_wkw)
+        plan = plan_downsampling(
+            source_wkw.header, [mag_factors], buffer_edge_len, args
+        )
+        buffer_edge_len = plan.buffer_edge_len
+        args = apply_downsampling_plan(plan, args)
         logging.debug(
             "Found source cubes: count={} size={} min={} max={}".format(
                 len(source_cube_addresses),
@@ -175,31 +584,37 @@ def downsample(
             )
         )
 
-    with open_wkw(source_wkw_info) as source_wkw:
-        num_channels = source_wkw.header.num_channels
-        header_block_type = (
-            wkw.Header.BLOCK_TYPE_LZ4HC if compress else wkw.Header.BLOCK_TYPE_RAW
-        )
+    create_target_wkw(source_wkw_info, target_wkw_info, compress)
 
-        extend_wkw_dataset_info_header(
-            target_wkw_info,
-            num_channels=num_channels,
-            file_len=source_wkw.header.file_len,
-            block_type=header_block_type,
-        )
+    journal = create_downsampling_journal(
+        target_wkw_info, source_mag, target_mag, interpolation_mode, compress, selection
+    )
+    non_empty_per_cube = journal.start()
+    pending_cube_addresses = [
+        target_cube_xyz
+        for target_cube_xyz in target_cube_addresses
+        if target_cube_xyz not in non_empty_per_cube
+    ]
 
-        ensure_wkw(target_wkw_info)
+    voxel_count_per_cube = (
+        source_wkw.header.file_len * source_wkw.header.block_len
+    ) ** 3
+    cubes_per_job = determine_cubes_per_job(
+        len(pending_cube_addresses), voxel_count_per_cube, args
+    )
+    logging.debug("Downsampling {} target cubes per job".format(cubes_per_job))
 
     with get_executor_for_args(args) as executor:
         job_args = []
-        voxel_count_per_cube = (
-            source_wkw.header.file_len * source_wkw.header.block_len
-        ) ** 3
-        job_count_per_log = math.ceil(
+        cube_count_per_log = math.ceil(
             1024 ** 3 / voxel_count_per_cube
         )  # log every gigavoxel of processed data
-        for i, target_cube_xyz in enumerate(target_cube_addresses):
-            use_logging = i % job_count_per_log == 0
+        target_cube_batches = list(get_chunks(pending_cube_addresses, cubes_per_job))
+        for i, target_cube_batch in enumerate(target_cube_batches):
+            cube_indices = range(
+                i * cubes_per_job, i * cubes_per_job + len(target_cube_batch)
+            )
+            use_logging = any(index % cube_count_per_log == 0 for index in cube_indices)
 
             job_args.append(
                 (
@@ -207,193 +622,959 @@ def downsample(
                     target_wkw_info,
                     mag_factors,
                     interpolation_mode,
-                    target_cube_xyz,
+                    target_cube_batch,
                     buffer_edge_len,
                     compress,
                     use_logging,
                 )
             )
-        wait_and_ensure_success(executor.map_to_futures(downsample_cube_job, job_args))
 
-    logging.info("Mag {0} successfully cubed".format(target_mag))
+        def record_job(job_index: int, job_non_empty_flags: List[bool]) -> None:
+            for target_cube_xyz, non_empty in zip(
+                target_cube_batches[job_index], job_non_empty_flags
+            ):
+                journal.record(target_cube_xyz, non_empty)
+                non_empty_per_cube[target_cube_xyz] = non_empty
+            journal.flush()
+
+        try:
+            wait_and_ensure_success(
+                executor.map_to_futures(downsample_cubes_job, job_args), record_job
+            )
+        finally:
+            journal.close()
+
+    if not keep_journal:
+        journal.remove()
+    non_empty_cube_addresses = [
+        target_cube_xyz
+        for target_cube_xyz in target_cube_addresses
+        if non_empty_per_cube[target_cube_xyz]
+    ]
+    logging.info(
+        "Mag {} successfully cubed ({} of {} target cubes contain data)".format(
+            target_mag, len(non_empty_cube_addresses), len(target_cube_addresses)
+        )
+    )
+    return non_empty_cube_addresses
+
+
+def determine_cubes_per_job(
+    cube_count: int, voxel_count_per_cube: int, args: Optional[Namespace]
+) -> int:
+    """
+    Returns --cubes_per_job if it is set. Otherwise, small cubes are grouped so that
+    a job processes about TARGET_VOXELS_PER_JOB voxels. With multiprocessing, every
+    worker still gets a job. Cluster executors ignore --jobs, so their jobs are only
+    limited by the voxel budget.
+    """
+    cubes_per_job = getattr(args, "cubes_per_job", None)
+    if cubes_per_job is not None:
+        return max(1, cubes_per_job)
+    cubes_per_budget = max(1, TARGET_VOXELS_PER_JOB // voxel_count_per_cube)
+    if getattr(args, "distribution_strategy", "multiprocessing") != "multiprocessing":
+        return cubes_per_budget
+    cubes_per_worker = max(1, math.ceil(cube_count / get_job_count(args)))
+    return min(cubes_per_budget, cubes_per_worker)
+
+
+def downsample_cubes_job(
+    args: Tuple[
+        WkwDatasetInfo,
+        WkwDatasetInfo,
+        List[int],
+        InterpolationModes,
+        List[Tuple[int, int, int]],
+        int,
+        bool,
+        bool,
+    ]
+) -> List[bool]:
+    """
+    Downsamples multiple target cubes with the datasets opened only once. A cube
+    is written in the background while the next one is read and downsampled.
+    Returns for every cube whether it contains data.
+    """
+    (
+        source_wkw_info,
+        target_wkw_info,
+        mag_factors,
+        interpolation_mode,
+        target_cube_xyzs,
+        buffer_edge_len,
+        compress,
+        use_logging,
+    ) = args
+
+    job_name = "Downsampling of {} cubes starting at {}".format(
+        len(target_cube_xyzs), target_cube_xyzs[0]
+    )
+    if use_logging:
+        logging.info(job_name)
+
+    try:
+        if use_logging:
+            time_start(job_name)
+        header_block_type = (
+            wkw.Header.BLOCK_TYPE_LZ4HC if compress else wkw.Header.BLOCK_TYPE_RAW
+        )
+
+        with open_wkw(source_wkw_info) as source_wkw:
+            extend_wkw_dataset_info_header(
+                target_wkw_info,
+                voxel_type=source_wkw.header.voxel_type,
+                num_channels=source_wkw.header.num_channels,
+                file_len=source_wkw.header.file_len,
+                block_type=header_block_type,
+            )
+
+            non_empty_flags = []
+            with open_wkw(target_wkw_info) as target_wkw:
+                with BackgroundWriter() as writer:
+                    for target_cube_xyz in target_cube_xyzs:
+                        file_buffer = read_and_downsample_cube(
+                            source_wkw,
+                            mag_factors,
+                            interpolation_mode,
+                            target_cube_xyz,
+                            buffer_edge_len,
+                        )
+                        writer.submit(
+                            write_target_cube, target_wkw, target_cube_xyz, file_buffer
+                        )
+                        non_empty_flags.append(file_buffer is not None)
+                        del file_buffer
+        if use_logging:
+            time_stop(job_name)
+        return non_empty_flags
+
+    except Exception as exc:
+        logging.error("{} failed with {}".format(job_name, exc))
+        raise exc
+
+
+def downsample_cube_job(
+    args: Tuple[
+        WkwDatasetInfo,
+        WkwDatasetInfo,
+        List[int],
+        InterpolationModes,
+        Tuple[int, int, int],
+        int,
+        bool,
+        bool,
+    ]
+) -> bool:
+    (
+        source_wkw_info,
+        target_wkw_info,
+        mag_factors,
+        interpolation_mode,
+        target_cube_xyz,
+        buffer_edge_len,
+        compress,
+        use_logging,
+    ) = args
+
+    return downsample_cubes_job(
+        (
+            source_wkw_info,
+            target_wkw_info,
+            mag_factors,
+            interpolation_mode,
+            [target_cube_xyz],
+            buffer_edge_len,
+            compress,
+            use_logging,
+        )
+    )[0]
+
+
+def read_and_downsample_cube(
+    source_wkw: wkw.Dataset,
+    mag_factors: List[int],
+    interpolation_mode: InterpolationModes,
+    target_cube_xyz: Tuple[int, int, int],
+    buffer_edge_len: int,
+) -> Optional[np.ndarray]:
+    """
+    Reads the source region which corresponds to the given target cube tile by tile
+    and returns the downsampled data as a buffer of shape (channels, x, y, z).
+    If the whole source region is empty, None is returned and no buffer is allocated.
+    """
+    num_channels = source_wkw.header.num_channels
+    source_dtype = source_wkw.header.voxel_type
+    wkw_cubelength = source_wkw.header.file_len * source_wkw.header.block_len
+    shape = (num_channels,) + (wkw_cubelength,) * 3
+    file_buffer = None
+    tile_length = buffer_edge_len
+    tile_count_per_dim = wkw_cubelength // tile_length
+
+    assert (
+        wkw_cubelength % buffer_edge_len == 0
+    ), "buffer_cube_size must be a divisor of wkw cube length"
+
+    tile_indices = list(range(0, tile_count_per_dim))
+    tiles = product(tile_indices, tile_indices, tile_indices)
+    file_offset = wkw_cubelength * np.array(target_cube_xyz)
+    target_offsets = [np.array(tile) * tile_length + file_offset for tile in tiles]
+    source_size = wkw_cubelength * np.array(mag_factors) // tile_count_per_dim
+
+    # Read the source buffers, the next tile is read while the current one
+    # is downsampled
+    source_tiles = iterate_prefetched(
+        source_wkw.read,
+        (
+            (mag_factors * target_offset, source_size)
+            for target_offset in target_offsets
+        ),
+    )
+    for target_offset, cube_buffer_channels in zip(target_offsets, source_tiles):
+        if not np.any(cube_buffer_channels):
+            continue
+        if file_buffer is None:
+            file_buffer = np.zeros(shape, source_dtype)
+
+        # Downsample all channels at once
+        buffer_offset = target_offset - file_offset
+        buffer_end = buffer_offset + tile_length
+
+        file_buffer[
+            :,
+            buffer_offset[0] : buffer_end[0],
+            buffer_offset[1] : buffer_end[1],
+            buffer_offset[2] : buffer_end[2],
+        ] = downsample_cube(cube_buffer_channels, mag_factors, interpolation_mode)
+
+    return file_buffer
+
+
+def read_existing_cube(
+    target_wkw: wkw.Dataset, target_cube_xyz: Tuple[int, int, int]
+) -> Optional[np.ndarray]:
+    """
+    Reads a whole cube which was written before (e.g., by a previous run) or
+    returns None if it does not exist or is empty.
+    """
+    if not os.path.exists(cube_file_path(target_wkw, target_cube_xyz)):
+        return None
+    wkw_cubelength = target_wkw.header.file_len * target_wkw.header.block_len
+    file_buffer = target_wkw.read(
+        wkw_cubelength * np.array(target_cube_xyz), (wkw_cubelength,) * 3
+    )
+    return file_buffer if np.any(file_buffer) else None
+
+
+def write_target_cube(
+    target_wkw: wkw.Dataset,
+    target_cube_xyz: Tuple[int, int, int],
+    file_buffer: Optional[np.ndarray],
+) -> bool:
+    """
+    Writes the buffer of a whole target cube and returns whether it contains data.
+    Empty cubes are not written at all. If a file from a previous run exists for
+    an empty cube, it is removed, so that the file system reflects the occupancy.
+    """
+    if file_buffer is None:
+        file_path = cube_file_path(target_wkw, target_cube_xyz)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return False
+
+    wkw_cubelength = file_buffer.shape[1]
+    target_wkw.write(wkw_cubelength * np.array(target_cube_xyz), file_buffer)
+    return True
+
+
+def downsample_fused(
+    source_wkw_info: WkwDatasetInfo,
+    target_wkw_infos: List[WkwDatasetInfo],
+    source_mag: Mag,
+    target_mags: List[Mag],
+    interpolation_mode: InterpolationModes,
+    compress: bool,
+    buffer_edge_len: int = None,
+    args: Namespace = None,
+    source_cube_addresses: List[Tuple[int, int, int]] = None,
+    keep_journal: bool = False,
+    incremental: bool = False,
+    selection: Dict[str, Any] = None,
+) -> List[Tuple[int, int, int]]:
+    """
+    Creates all target_mags in a single pass. Every job reads the source region
+    of one cube of the last target mag once and derives all intermediate mags
+    from memory, so that the intermediate mags never need to be read again.
+    Returns the addresses of the cubes of the last target mag which contain data.
+    Finished jobs are journaled in the last target mag like in downsample.
+    If incremental is set, source_cube_addresses are only a part of the source
+    data (e.g., dirty cubes), so that the cubes of the intermediate mags which
+    are not derived from them are read from disk instead of treated as empty.
+    The selection of a partial run (see describe_cube_selection) is journaled too.
+    """
+
+    assert len(target_mags) == len(target_wkw_infos)
+    logging.info(
+        "Downsampling mags {} from mag {} in a single pass".format(
+            ", ".join(str(mag) for mag in target_mags), source_mag
+        )
+    )
+
+    mag_factors_per_level = []
+    prev_mag = source_mag
+    for target_mag in target_mags:
+        assert prev_mag < target_mag
+        mag_factors_per_level.append(
+            [t // s for (t, s) in zip(target_mag.to_array(), prev_mag.to_array())]
+        )
+        prev_mag = target_mag
+
+    # Detect the cubes that we want to downsample on every level
+    cube_addresses_per_level = []
+    if source_cube_addresses is None:
+        source_cube_addresses = cube_addresses(source_wkw_info)
+    level_cube_addresses = source_cube_addresses
+    for mag_factors in mag_factors_per_level:
+        level_cube_addresses = get_target_cube_addresses(
+            level_cube_addresses, mag_factors
+        )
+        cube_addresses_per_level.append(level_cube_addresses)
+
+    # Group the cubes of the lower levels by the cube of the last level they belong to
+    top_cube_addresses = cube_addresses_per_level[-1]
+    cube_addresses_per_top_cube: Dict[
+        Tuple[int, int, int], List[List[Tuple[int, int, int]]]
+    ] = {xyz: [[] for _ in target_mags] for xyz in top_cube_addresses}
+    for level, level_cube_addresses in enumerate(cube_addresses_per_level):
+        factors_to_top = [1, 1, 1]
+        for mag_factors in mag_factors_per_level[level + 1 :]:
+            factors_to_top = [a * b for (a, b) in zip(factors_to_top, mag_factors)]
+        for xyz in level_cube_addresses:
+            top_xyz = cast(
+                Tuple[int, int, int],
+                tuple(dim // factor for (dim, factor) in zip(xyz, factors_to_top)),
+            )
+            cube_addresses_per_top_cube[top_xyz][level].append(xyz)
+
+    with open_wkw(source_wkw_info) as source_wkw:
+        plan = plan_downsampling(
+            source_wkw.header, mag_factors_per_level, buffer_edge_len, args
+        )
+        buffer_edge_len = plan.buffer_edge_len
+        args = apply_downsampling_plan(plan, args)
+        num_channels = source_wkw.header.num_channels
+        file_len = source_wkw.header.file_len
+        header_block_type = (
+            wkw.Header.BLOCK_TYPE_LZ4HC if compress else wkw.Header.BLOCK_TYPE_RAW
+        )
+
+        for target_wkw_info in target_wkw_infos:
+            extend_wkw_dataset_info_header(
+                target_wkw_info,
+                num_channels=num_channels,
+                file_len=file_len,
+                block_type=header_block_type,
+            )
+            ensure_wkw(target_wkw_info)
+
+    logging.debug(
+        "Found target cubes: count={} top level count={}".format(
+            sum(len(level) for level in cube_addresses_per_level),
+            len(top_cube_addresses),
+        )
+    )
+
+    description: Dict[str, Any] = {
+        "source_mag": source_mag.to_layer_name(),
+        "target_mags": [target_mag.to_layer_name() for target_mag in target_mags],
+        "interpolation_mode": interpolation_mode.name,
+        "compress": compress,
+    }
+    if selection is not None:
+        description["selection"] = selection
+    journal = DownsamplingJournal(target_wkw_infos[-1], description)
+    results_per_top_cube = {
+        top_cube_xyz: [
+            [cast(Tuple[int, int, int], tuple(xyz)) for xyz in level]
+            for level in result
+        ]
+        for top_cube_xyz, result in journal.start().items()
+    }
+    pending_top_cube_addresses = [
+        top_cube_xyz
+        for top_cube_xyz in top_cube_addresses
+        if top_cube_xyz not in results_per_top_cube
+    ]
+
+    with get_executor_for_args(args) as executor:
+        job_args = []
+        for top_cube_xyz in pending_top_cube_addresses:
+            job_args.append(
+                (
+                    source_wkw_info,
+                    target_wkw_infos,
+                    mag_factors_per_level,
+                    interpolation_mode,
+                    top_cube_xyz,
+                    cube_addresses_per_top_cube[top_cube_xyz],
+                    buffer_edge_len,
+                    compress,
+                    incremental,
+                )
+            )
+
+        def record_job(
+            job_index: int, job_result: List[List[Tuple[int, int, int]]]
+        ) -> None:
+            top_cube_xyz = pending_top_cube_addresses[job_index]
+            journal.record(top_cube_xyz, job_result)
+            journal.flush()
+            results_per_top_cube[top_cube_xyz] = job_result
+
+        try:
+            wait_and_ensure_success(
+                executor.map_to_futures(downsample_fused_cube_job, job_args),
+                record_job,
+            )
+        finally:
+            journal.close()
+
+    if not keep_journal:
+        journal.remove()
+    job_results = [
+        results_per_top_cube[top_cube_xyz] for top_cube_xyz in top_cube_addresses
+    ]
+
+    for level, target_mag in enumerate(target_mags):
+        logging.info(
+            "Mag {} successfully cubed ({} of {} target cubes contain data)".format(
+                target_mag,
+                sum(len(job_result[level]) for job_result in job_results),
+                len(cube_addresses_per_level[level]),
+            )
+        )
+    return sorted(
+        (
+            target_cube_xyz
+            for job_result in job_results
+            for target_cube_xyz in job_result[-1]
+        ),
+        key=morton_code,
+    )
+
+
+def downsample_fused_cube_job(
+    args: Tuple[
+        WkwDatasetInfo,
+        List[WkwDatasetInfo],
+        List[List[int]],
+        InterpolationModes,
+        Tuple[int, int, int],
+        List[List[Tuple[int, int, int]]],
+        int,
+        bool,
+        bool,
+    ]
+) -> List[List[Tuple[int, int, int]]]:
+    (
+        source_wkw_info,
+        target_wkw_infos,
+        mag_factors_per_level,
+        interpolation_mode,
+        top_cube_xyz,
+        cube_addresses_per_level,
+        buffer_edge_len,
+        compress,
+        incremental,
+    ) = args
+
+    logging.info("Downsampling of {} (single pass)".format(top_cube_xyz))
+
+    try:
+        time_start("Downsampling of {} (single pass)".format(top_cube_xyz))
+        header_block_type = (
+            wkw.Header.BLOCK_TYPE_LZ4HC if compress else wkw.Header.BLOCK_TYPE_RAW
+        )
+
+        with open_wkw(source_wkw_info) as source_wkw:
+            for target_wkw_info in target_wkw_infos:
+                extend_wkw_dataset_info_header(
+                    target_wkw_info,
+                    voxel_type=source_wkw.header.voxel_type,
+                    num_channels=source_wkw.header.num_channels,
+                    file_len=source_wkw.header.file_len,
+                    block_type=header_block_type,
+                )
+
+            target_wkws = [open_wkw(info) for info in target_wkw_infos]
+            non_empty_cube_addresses_per_level: List[List[Tuple[int, int, int]]] = [
+                [] for _ in target_wkws
+            ]
+            try:
+                with BackgroundWriter() as writer:
+                    downsample_fused_cube(
+                        source_wkw,
+                        target_wkws,
+                        mag_factors_per_level,
+                        interpolation_mode,
+                        len(target_wkws) - 1,
+                        top_cube_xyz,
+                        [set(level) for level in cube_addresses_per_level],
+                        buffer_edge_len,
+                        non_empty_cube_addresses_per_level,
+                        writer,
+                        incremental,
+                    )
+            finally:
+                for target_wkw in target_wkws:
+                    target_wkw.close()
+        time_stop("Downsampling of {} (single pass)".format(top_cube_xyz))
+        return non_empty_cube_addresses_per_level
+
+    except Exception as exc:
+        logging.error(
+            "Downsampling of {} (single pass) failed with {}".format(top_cube_xyz, exc)
+        )
+        raise exc
+
+
+def downsample_fused_cube(
+    source_wkw: wkw.Dataset,
+    target_wkws: List[wkw.Dataset],
+    mag_factors_per_level: List[List[int]],
+    interpolation_mode: InterpolationModes,
+    level: int,
+    target_cube_xyz: Tuple[int, int, int],
+    cube_addresses_per_level: List[Set[Tuple[int, int, int]]],
+    buffer_edge_len: int,
+    non_empty_cube_addresses_per_level: List[List[Tuple[int, int, int]]],
+    writer: BackgroundWriter,
+    incremental: bool = False,
+) -> Optional[np.ndarray]:
+    """
+    Computes the cube at target_cube_xyz of the given level, writes it (in the
+    background, see BackgroundWriter) and returns its data (or None if it is empty). The lowest level is read from
+    the source dataset, the other levels are assembled from the (recursively
+    computed) cubes of the level below, which are held in memory only once at a time.
+    Cubes of the level below which are not in cube_addresses_per_level are empty,
+    unless incremental is set, in which case their existing data is read.
+    """
+    if level == 0:
+        file_buffer = read_and_downsample_cube(
+            source_wkw,
+            mag_factors_per_level[0],
+            interpolation_mode,
+            target_cube_xyz,
+            buffer_edge_len,
+        )
+    else:
+        num_channels = source_wkw.header.num_channels
+        wkw_cubelength = source_wkw.header.file_len * source_wkw.header.block_len
+        mag_factors = mag_factors_per_level[level]
+        file_buffer = None
+        sub_cube_length = np.array(
+            [wkw_cubelength // mag_factor for mag_factor in mag_factors]
+        )
+        for sub_cube_offset in product(*(range(factor) for factor in mag_factors)):
+            child_cube_xyz = cast(
+                Tuple[int, int, int],
+                tuple(
+                    dim * factor + offset
+                    for (dim, factor, offset) in zip(
+                        target_cube_xyz, mag_factors, sub_cube_offset
+                    )
+                ),
+            )
+            if child_cube_xyz in cube_addresses_per_level[level - 1]:
+                child_buffer = downsample_fused_cube(
+                    source_wkw,
+                    target_wkws,
+                    mag_factors_per_level,
+                    interpolation_mode,
+                    level - 1,
+                    child_cube_xyz,
+                    cube_addresses_per_level,
+                    buffer_edge_len,
+                    non_empty_cube_addresses_per_level,
+                    writer,
+                    incremental,
+                )
+            elif incremental:
+                # The cube is not recomputed, but still contributes its data
+                child_buffer = read_existing_cube(
+                    target_wkws[level - 1], child_cube_xyz
+                )
+            else:
+                continue
+            if child_buffer is None:
+                continue
+            if file_buffer is None:
+                file_buffer = np.zeros(
+                    (num_channels,) + (wkw_cubelength,) * 3,
+                    source_wkw.header.voxel_type,
+                )
+
+            buffer_offset = np.array(sub_cube_offset) * sub_cube_length
+            buffer_end = buffer_offset + sub_cube_length
+            file_buffer[
+                :,
+                buffer_offset[0] : buffer_end[0],
+                buffer_offset[1] : buffer_end[1],
+                buffer_offset[2] : buffer_end[2],
+            ] = downsample_cube(child_buffer, mag_factors, interpolation_mode)
+            del child_buffer
+
+    # The buffer is not modified anymore, so it can be written while the
+    # next cubes are computed
+    writer.submit(write_target_cube, target_wkws[level], target_cube_xyz, file_buffer)
+    if file_buffer is not None:
+        non_empty_cube_addresses_per_level[level].append(target_cube_xyz)
+    return file_buffer
+
+
+def block_view(data: np.ndarray, factors: List[int]) -> np.ndarray:
+    """
+    Returns a view with the shape factors + (data.shape // factors) on the data
+    without copying it. block_view(data, factors)[i, j, k] is a view which contains
+    the voxel at position (i, j, k) of every block.
+    """
+    ds = data.shape
+    assert not any((d % factor > 0 for (d, factor) in zip(ds, factors)))
+    shape = tuple(factors) + tuple(d // factor for (d, factor) in zip(ds, factors))
+    strides = data.strides + tuple(
+        stride * factor for (stride, factor) in zip(data.strides, factors)
+    )
+    return as_strided(data, shape=shape, strides=strides, writeable=False)
+
+
+def block_votes(data: np.ndarray, factors: List[int]) -> List[np.ndarray]:
+    """
+    Returns one (strided, read-only) view per voxel position in a block,
+    e.g. 8 views for 2-2-2. The i-th voxels of all views form the i-th block.
+    """
+    view = block_view(data, factors)
+    return [view[index] for index in product(*(range(factor) for factor in factors))]
+
+
+def non_linear_filter_3d(
+    data: np.ndarray,
+    factors: List[int],
+    func: Callable[[List[np.ndarray]], np.ndarray],
+) -> np.ndarray:
+    """
+    Applies func to the votes (see block_votes) of every block. func needs to
+    be independent of the order of the votes and must not modify them.
+    data may have leading (channel) axes in front of x, y and z, which are
+    not downsampled.
+    """
+    factors = [1] * (data.ndim - len(factors)) + list(factors)
+    if data.strides[-3] < data.strides[-1]:
+        # Element-wise operations on the strided views are much faster if they
+        # follow the memory layout. Therefore, fortran ordered data (as read from
+        # wkw) is processed as a view with reversed x, y and z axes. The channel
+        # axes stay in front, so that the (c ordered) results are channel planar.
+        axes = list(range(data.ndim - 3)) + [
+            data.ndim - 1,
+            data.ndim - 2,
+            data.ndim - 3,
+        ]
+        votes = block_votes(data.transpose(axes), [factors[axis] for axis in axes])
+        return func(votes).transpose(axes)
+    return func(block_votes(data, factors))
+
+
+def linear_filter_3d(
+    data: np.ndarray, factors: List[int], order: int, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Downsamples the data with a spline interpolation of the given order
+    (0: nearest, 1: bilinear, 2: bicubic) at the sample positions of
+    scipy.ndimage.zoom. The interpolation is separable, so the axes are
+    resampled one after another, each with its own factor.
+    """
+    assert not any(d % f > 0 for d, f in zip(data.shape, factors))
+    output_shape = tuple(size // factor for size, factor in zip(data.shape, factors))
+    if out is None:
+        out = np.empty(output_shape, dtype=data.dtype)
+    if data.strides[0] < data.strides[-1]:
+        # Work on the C-ordered view (e.g., of wkw's fortran-ordered buffers)
+        linear_filter_3d(data.T, factors[::-1], order, out.T)
+        return out
+
+    # The outermost axis is resampled in slabs of output rows, so that the
+    # float intermediates stay small. Within a slab, the axes are resampled
+    # by copying contiguous slabs, the innermost axis last.
+    if factors[0] > 1:
+        coefficients, indices, weights = _spline_taps(data, 0, output_shape[0], order)
+    for start in range(0, output_shape[0], LINEAR_FILTER_SLAB_LEN):
+        end = min(start + LINEAR_FILTER_SLAB_LEN, output_shape[0])
+        if factors[0] > 1:
+            slab = _resample_axis(
+                coefficients, indices[:, start:end], weights[:, start:end], 0
+            )
+        else:
+            slab = data[start:end]
+        for axis in range(1, data.ndim):
+            if factors[axis] > 1:
+                slab = _resample_axis(
+                    *_spline_taps(slab, axis, output_shape[axis], order), axis
+                )
+
+        if slab.dtype != out.dtype and np.issubdtype(out.dtype, np.integer):
+            dtype_info = np.iinfo(out.dtype)
+            np.rint(slab, out=slab)
+            np.clip(slab, dtype_info.min, dtype_info.max, out=slab)
+        out[start:end] = slab
+    return out
 
 
-def downsample_cube_job(
-    args: Tuple[
-        WkwDatasetInfo,
-        WkwDatasetInfo,
-        List[int],
-        InterpolationModes,
-        Tuple[int, int, int],
-        int,
-        bool,
-        bool,
-    ]
-) -> None:
-    (
-        source_wkw_info,
-        target_wkw_info,
-        mag_factors,
-        interpolation_mode,
-        target_cube_xyz,
-        buffer_edge_len,
-        compress,
-        use_logging,
-    ) = args
+def _spline_taps(
+    data: np.ndarray, axis: int, output_len: int, order: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the spline coefficients of the data along the axis, as well as the
+    indices into the coefficients and the weights of the samples (both of
+    shape (order + 1, output_len)) which contribute to the output positions.
+    """
+    input_len = data.shape[axis]
+    step = (input_len - 1) / (output_len - 1) if output_len > 1 else 1
+    positions = np.arange(output_len) * step
+    if order > 1:
+        padding = [(0, 0)] * data.ndim
+        padding[axis] = (SPLINE_PADDING, SPLINE_PADDING)
+        data = spline_filter1d(
+            np.pad(data, padding, mode="edge"),
+            order,
+            axis=axis,
+            output=np.float64,
+            mode="mirror",
+        )
+        positions += SPLINE_PADDING
 
-    if use_logging:
-        logging.info("Downsampling of {}".format(target_cube_xyz))
+    indices, weights = _spline_weights(positions, order)
+    # Samples beyond the border repeat the edge (mode "nearest" of zoom)
+    np.clip(indices, 0, data.shape[axis] - 1, out=indices)
+    return data, indices, weights
 
-    try:
-        if use_logging:
-            time_start("Downsampling of {}".format(target_cube_xyz))
-        header_block_type = (
-            wkw.Header.BLOCK_TYPE_LZ4HC if compress else wkw.Header.BLOCK_TYPE_RAW
-        )
 
-        with open_wkw(source_wkw_info) as source_wkw:
-            num_channels = source_wkw.header.num_channels
-            source_dtype = source_wkw.header.voxel_type
+def _resample_axis(
+    coefficients: np.ndarray, indices: np.ndarray, weights: np.ndarray, axis: int
+) -> np.ndarray:
+    if len(indices) == 1:
+        return np.take(coefficients, indices[0], axis=axis)
 
-            extend_wkw_dataset_info_header(
-                target_wkw_info,
-                voxel_type=source_dtype,
-                num_channels=num_channels,
-                file_len=source_wkw.header.file_len,
-                block_type=header_block_type,
-            )
+    weight_shape = [1] * coefficients.ndim
+    weight_shape[axis] = indices.shape[1]
+    result = np.take(coefficients, indices[0], axis=axis) * weights[0].reshape(
+        weight_shape
+    )
+    for tap_indices, tap_weights in zip(indices[1:], weights[1:]):
+        result += np.take(coefficients, tap_indices, axis=axis) * tap_weights.reshape(
+            weight_shape
+        )
+    return result
 
-            with open_wkw(target_wkw_info) as target_wkw:
-                wkw_cubelength = (
-                    source_wkw.header.file_len * source_wkw.header.block_len
-                )
-                shape = (num_channels,) + (wkw_cubelength,) * 3
-                file_buffer = np.zeros(shape, source_dtype)
-                tile_length = buffer_edge_len
-                tile_count_per_dim = wkw_cubelength // tile_length
-
-                assert (
-                    wkw_cubelength % buffer_edge_len == 0
-                ), "buffer_cube_size must be a divisor of wkw cube length"
-
-                tile_indices = list(range(0, tile_count_per_dim))
-                tiles = product(tile_indices, tile_indices, tile_indices)
-                file_offset = wkw_cubelength * np.array(target_cube_xyz)
-
-                for tile in tiles:
-                    target_offset = np.array(
-                        tile
-                    ) * tile_length + wkw_cubelength * np.array(target_cube_xyz)
-                    source_offset = mag_factors * target_offset
-
-                    # Read source buffer
-                    cube_buffer_channels = source_wkw.read(
-                        source_offset,
-                        (wkw_cubelength * np.array(mag_factors) // tile_count_per_dim),
-                    )
 
-                    for channel_index in range(num_channels):
-                        cube_buffer = cube_buffer_channels[channel_index]
+def _spline_weights(positions: np.ndarray, order: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the indices and the weights (both of shape (order + 1, positions))
+    of the samples which contribute to the B-spline interpolation of the
+    given order at the given positions.
+    """
+    if order % 2 == 0:
+        first = np.floor(positions + 0.5).astype(np.intp) - order // 2
+    else:
+        first = np.floor(positions).astype(np.intp) - order // 2
+    indices = first + np.arange(order + 1)[:, np.newaxis]
+    distances = np.abs(indices - positions)
+    if order == 0:
+        weights = np.ones(distances.shape)
+    elif order == 1:
+        weights = 1 - distances
+    elif order == 2:
+        weights = np.where(
+            distances < 0.5, 0.75 - distances ** 2, 0.5 * (1.5 - distances) ** 2
+        )
+    elif order == 3:
+        weights = np.where(
+            distances < 1,
+            2 / 3 - distances ** 2 + distances ** 3 / 2,
+            (2 - distances) ** 3 / 6,
+        )
+    else:
+        raise Exception("Unsupported spline order: {}".format(order))
+    return indices, weights
 
-                        if not np.all(cube_buffer == 0):
-                            # Downsample the buffer
 
-                            data_cube = downsample_cube(
-                                cube_buffer, mag_factors, interpolation_mode
-                            )
+def _max(votes: List[np.ndarray]) -> np.ndarray:
+    result = np.array(votes[0], order="C")
+    for vote in votes[1:]:
+        np.maximum(result, vote, out=result)
+    return result
 
-                            buffer_offset = target_offset - file_offset
-                            buffer_end = buffer_offset + tile_length
 
-                            file_buffer[
-                                channel_index,
-                                buffer_offset[0] : buffer_end[0],
-                                buffer_offset[1] : buffer_end[1],
-                                buffer_offset[2] : buffer_end[2],
-                            ] = data_cube
+def _min(votes: List[np.ndarray]) -> np.ndarray:
+    result = np.array(votes[0], order="C")
+    for vote in votes[1:]:
+        np.minimum(result, vote, out=result)
+    return result
 
-                # Write the downsampled buffer to target
-                target_wkw.write(file_offset, file_buffer)
-        if use_logging:
-            time_stop("Downsampling of {}".format(target_cube_xyz))
 
-    except Exception as exc:
-        logging.error("Downsampling of {} failed with {}".format(target_cube_xyz, exc))
-        raise exc
+def _median(votes: List[np.ndarray]) -> np.ndarray:
+    vote_count = len(votes)
+    is_unsigned = np.issubdtype(votes[0].dtype, np.unsignedinteger)
+    if (
+        is_unsigned
+        and vote_count <= SMALL_BLOCK_MAX_VOTES
+        and vote_count & (vote_count - 1) == 0
+    ):
+        return _sorting_network_median(votes)
+
+    x = np.stack(votes)
+    if is_unsigned:
+        # Select the middle element(s) without converting to float. For an even
+        # number of elements, the floored mean is computed like np.median + astype
+        lower_index = (vote_count - 1) // 2
+        upper_index = vote_count // 2
+        x = np.partition(x, [lower_index, upper_index], axis=0)
+        if lower_index == upper_index:
+            return x[lower_index]
+        return _floored_mean(x[lower_index], x[upper_index])
+    return np.median(x, axis=0).astype(x.dtype)
 
 
-def non_linear_filter_3d(
-    data: np.ndarray, factors: List[int], func: Callable[[np.ndarray], np.ndarray]
-) -> np.ndarray:
-    ds = data.shape
-    assert not any((d % factor > 0 for (d, factor) in zip(ds, factors)))
-    data = data.reshape((ds[0], factors[1], ds[1] // factors[1], ds[2]), order="F")
-    data = data.swapaxes(0, 1)
-    data = data.reshape(
-        (
-            factors[0] * factors[1],
-            ds[0] * ds[1] // (factors[0] * factors[1]),
-            factors[2],
-            ds[2] // factors[2],
-        ),
-        order="F",
-    )
-    data = data.swapaxes(2, 1)
-    data = data.reshape(
-        (
-            factors[0] * factors[1] * factors[2],
-            (ds[0] * ds[1] * ds[2]) // (factors[0] * factors[1] * factors[2]),
-        ),
-        order="F",
-    )
-    data = func(data)
-    data = data.reshape(
-        (ds[0] // factors[0], ds[1] // factors[1], ds[2] // factors[2]), order="F"
+def _accumulator_dtype(dtype: np.dtype, vote_count: int) -> Optional[np.dtype]:
+    """
+    Returns the smallest integer dtype of the same kind which can hold the sum of
+    vote_count values of dtype (plus the rounding offset), or None if there is none.
+    """
+    info = np.iinfo(dtype)
+    candidates = (
+        ["uint16", "uint32", "uint64"] if info.min == 0 else ["int16", "int32", "int64"]
     )
-    return data
-
+    for candidate in candidates:
+        candidate_info = np.iinfo(candidate)
+        if (
+            info.max * vote_count + vote_count // 2 <= candidate_info.max
+            and info.min * vote_count >= candidate_info.min
+        ):
+            return np.dtype(candidate)
+    return None
 
-def linear_filter_3d(data: np.ndarray, factors: List[int], order: int) -> np.ndarray:
-    factors_np = np.array(factors)
 
-    if not np.all(factors_np == factors[0]):
-        logging.debug(
-            "the selected filtering strategy does not support anisotropic downsampling. Selecting {} as uniform downsampling factor".format(
-                factors[0]
-            )
-        )
-    factor = factors[0]
+def _average(votes: List[np.ndarray]) -> np.ndarray:
+    """
+    Mean of the votes of every block. Integers are summed up in a wider
+    accumulator and the mean is rounded half up, so no float conversion is
+    necessary. 64 bit integers have no wider accumulator: their quotients and
+    remainders (with respect to the vote count) are accumulated separately.
+    """
+    vote_count = len(votes)
+    dtype = votes[0].dtype
+    if not np.issubdtype(dtype, np.integer):
+        float_sum = np.zeros(votes[0].shape, dtype=np.float64)
+        for vote in votes:
+            float_sum += vote
+        float_sum /= vote_count
+        return float_sum.astype(dtype)
+
+    accumulator_dtype = _accumulator_dtype(dtype, vote_count)
+    if accumulator_dtype is not None:
+        total = np.zeros(votes[0].shape, dtype=accumulator_dtype)
+        for vote in votes:
+            total += vote
+        total += vote_count // 2
+        total //= vote_count
+        return total.astype(dtype)
+
+    # sum(vote) == sum(vote // n) * n + sum(vote % n). The sum of the quotients
+    # might wrap around for signed data, which is harmless since the final
+    # result is within the value range of dtype again.
+    quotients = np.zeros(votes[0].shape, dtype=dtype)
+    remainders = np.zeros(votes[0].shape, dtype=dtype)
+    for vote in votes:
+        quotients += vote // vote_count
+        remainders += vote % vote_count
+    remainders += vote_count // 2
+    remainders //= vote_count
+    quotients += remainders
+    return quotients
+
+
+def _floored_mean(lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+    """
+    Computes (lower + upper) // 2 for unsigned integers with lower <= upper
+    without overflowing. Note that upper is overwritten.
+    """
+    upper -= lower
+    upper //= 2
+    upper += lower
+    return upper
+
+
+def _odd_even_merge(lo: int, hi: int, step: int) -> Iterator[Tuple[int, int]]:
+    double_step = step * 2
+    if double_step < hi - lo:
+        yield from _odd_even_merge(lo, hi, double_step)
+        yield from _odd_even_merge(lo + step, hi, double_step)
+        for i in range(lo + step, hi - step, double_step):
+            yield (i, i + step)
+    else:
+        yield (lo, lo + step)
 
-    ds = data.shape
-    assert not any((d % factor > 0 for d in ds))
-    return zoom(
-        data,
-        1 / factor,
-        output=data.dtype,
-        # 0: nearest
-        # 1: bilinear
-        # 2: bicubic
-        order=order,
-        # this does not mean nearest interpolation,
-        # it corresponds to how the borders are treated.
-        mode="nearest",
-        prefilter=True,
-    )
 
+def _odd_even_merge_sort(lo: int, hi: int) -> Iterator[Tuple[int, int]]:
+    """
+    Yields the comparators of Batcher's odd-even merge sort network for the
+    elements lo to hi (both inclusive). The number of elements must be a power of two.
+    """
+    if hi - lo >= 1:
+        mid = lo + (hi - lo) // 2
+        yield from _odd_even_merge_sort(lo, mid)
+        yield from _odd_even_merge_sort(mid + 1, hi)
+        yield from _odd_even_merge(lo, hi, 1)
 
-def _max(x: np.ndarray) -> np.ndarray:
-    return np.max(x, axis=0)
 
+def _sorting_network_median(votes: List[np.ndarray]) -> np.ndarray:
+    """
+    Median of few unsigned integer votes per voxel (e.g., the 8 voxels of a
+    2-2-2 block). The votes are sorted by a sorting network of element-wise
+    min/max operations, so that the data stays in its dtype. The passed
+    votes are not modified: every vote is replaced by a new array when it is
+    touched for the first time and updated in place afterwards.
+    """
+    vote_count = len(votes)
+    assert vote_count & (vote_count - 1) == 0, "Vote count must be a power of two"
+    votes = list(votes)
+    is_owned = [False] * vote_count
+    tmp = None
+    for i, j in _odd_even_merge_sort(0, vote_count - 1):
+        if tmp is None:
+            tmp = np.empty(votes[i].shape, votes[i].dtype)
+        np.minimum(votes[i], votes[j], out=tmp)
+        if is_owned[j]:
+            np.maximum(votes[i], votes[j], out=votes[j])
+        else:
+            votes[j] = np.maximum(
+                votes[i], votes[j], out=np.empty(votes[j].shape, votes[j].dtype)
+            )
+            is_owned[j] = True
+        votes[i], tmp = tmp, (votes[i] if is_owned[i] else None)
+        is_owned[i] = True
 
-def _min(x: np.ndarray) -> np.ndarray:
-    return np.min(x, axis=0)
+    lower = votes[(vote_count - 1) // 2]
+    upper = votes[vote_count // 2]
+    if lower is upper:
+        return lower
+    return _floored_mean(lower, upper)
 
 
-def _median(x: np.ndarray) -> np.ndarray:
-    return np.median(x, axis=0).astype(x.dtype)
+def _mode(votes: List[np.ndarray]) -> np.ndarray:
+    if len(votes) <= SMALL_BLOCK_MAX_VOTES:
+        return _pairwise_mode(votes)
+    return _sort_mode(np.stack(votes))
 
 
-def _mode(x: np.ndarray) -> np.ndarray:
+def _sort_mode(x: np.ndarray) -> np.ndarray:
     """
     Fast mode implementation from: https://stackoverflow.com/a/35674754
     """
@@ -440,50 +1621,163 @@ def _mode(x: np.ndarray) -> np.ndarray:
     return sort[tuple(index)]
 
 
+def _pairwise_mode(votes: List[np.ndarray]) -> np.ndarray:
+    """
+    Mode for few votes per voxel (e.g., the 8 voxels of a 2-2-2 block) by
+    counting the pairwise equalities of the votes. Like _sort_mode, ties are
+    resolved in favor of the smallest value.
+    """
+    counts = [np.ones(votes[0].shape, np.uint8) for _ in votes]
+    equal = np.empty(votes[0].shape, dtype=bool)
+    for i in range(len(votes)):
+        for j in range(i + 1, len(votes)):
+            np.equal(votes[i], votes[j], out=equal)
+            counts[i] += equal
+            counts[j] += equal
+
+    result = np.array(votes[0], order="C")
+    max_count = counts[0]
+    is_better = np.empty(votes[0].shape, dtype=bool)
+    is_tie = np.empty(votes[0].shape, dtype=bool)
+    for i in range(1, len(votes)):
+        np.greater(counts[i], max_count, out=is_better)
+        np.equal(counts[i], max_count, out=is_tie)
+        is_tie &= votes[i] < result
+        is_better |= is_tie
+        np.copyto(result, votes[i], where=is_better)
+        np.maximum(max_count, counts[i], out=max_count)
+    return result
+
+
+def _label_mode(votes: List[np.ndarray]) -> np.ndarray:
+    """
+    Mode for segmentation data where most blocks contain a single label.
+    Uniform blocks are copied directly. For the remaining blocks, the labels
+    are remapped to a dense local range (their rank within the sorted block),
+    so that the winner can be found with a single bincount and argmax.
+    Like _sort_mode, ties are resolved in favor of the smallest label.
+    """
+    result = np.array(votes[0], order="C")
+    is_mixed = np.zeros(result.shape, dtype=bool)
+    differs = np.empty(result.shape, dtype=bool)
+    for vote in votes[1:]:
+        np.not_equal(vote, result, out=differs)
+        is_mixed |= differs
+    mixed = np.nonzero(is_mixed)
+    block_count = len(mixed[0])
+    if block_count == 0:
+        return result
+    if block_count > result.size * LABEL_MODE_MAX_MIXED_RATIO:
+        # Noise-like data, gathering the mixed blocks does not pay off
+        return _mode(votes)
+
+    vote_count = len(votes)
+    mixed_votes = np.empty((vote_count, block_count), dtype=result.dtype)
+    for i, vote in enumerate(votes):
+        mixed_votes[i] = vote[mixed]
+    mixed_votes.sort(axis=0)
+
+    # keys = local_label * block_count + block, where the local label is the
+    # number of distinct labels below the vote in its (sorted) block
+    keys = np.empty((vote_count, block_count), dtype=np.intp)
+    keys[0] = np.arange(block_count)
+    for i in range(1, vote_count):
+        np.not_equal(mixed_votes[i], mixed_votes[i - 1], out=keys[i])
+        keys[i] *= block_count
+        keys[i] += keys[i - 1]
+    counts = np.bincount(keys.ravel(), minlength=vote_count * block_count)
+    # argmax returns the first maximum, i.e., the smallest label on ties
+    winners = np.argmax(counts.reshape(vote_count, block_count), axis=0)
+    winners *= block_count
+    winners += keys[0]
+
+    mixed_result = mixed_votes[0]
+    for i in range(1, vote_count):
+        np.copyto(mixed_result, mixed_votes[i], where=keys[i] == winners)
+    result[mixed] = mixed_result
+    return result
+
+
+def _prefers_jit_kernel(
+    interpolation_mode: InterpolationModes, dtype: np.dtype, factors: List[int]
+) -> bool:
+    """
+    The JIT kernels are faster than the NumPy filters where these sort the votes
+    or stack the blocks, i.e., for the mode of 32 and 64 bit labels, for blocks
+    with many votes and for the average of 64 bit data (which has no wider
+    accumulator). Otherwise the vectorized NumPy filters are faster.
+    """
+    if interpolation_mode.name not in JIT_KERNEL_NAMES:
+        return False
+    many_votes = int(np.prod(factors)) > SMALL_BLOCK_MAX_VOTES
+    if interpolation_mode == InterpolationModes.AVERAGE:
+        return dtype.itemsize == 8
+    if interpolation_mode == InterpolationModes.MEDIAN:
+        return many_votes or dtype.itemsize == 8
+    return many_votes or dtype.itemsize >= 4
+
+
 def downsample_cube(
-    cube_buffer: np.ndarray, factors: List[int], interpolation_mode: InterpolationModes
+    cube_buffer: np.ndarray,
+    factors: List[int],
+    interpolation_mode: InterpolationModes,
+    out: Optional[np.ndarray] = None,
 ) -> np.ndarray:
-    if interpolation_mode == InterpolationModes.MODE:
-        return non_linear_filter_3d(cube_buffer, factors, _mode)
+    """
+    Downsamples a buffer of shape (x, y, z) or (channels, x, y, z) by the given
+    factors. Multi-channel buffers are filtered in a single (vectorized) pass
+    except for the linear interpolation modes, which work channel by channel.
+    If `out` is given, the result is written into it.
+    """
+    if cube_buffer.ndim == 4 and interpolation_mode in (
+        InterpolationModes.NEAREST,
+        InterpolationModes.BILINEAR,
+        InterpolationModes.BICUBIC,
+    ):
+        if out is None:
+            out = np.empty(
+                (cube_buffer.shape[0],)
+                + tuple(
+                    size // factor
+                    for size, factor in zip(cube_buffer.shape[1:], factors)
+                ),
+                dtype=cube_buffer.dtype,
+            )
+        for channel, out_channel in zip(cube_buffer, out):
+            downsample_cube(channel, factors, interpolation_mode, out=out_channel)
+        return out
+    jit_result = None
+    if _prefers_jit_kernel(interpolation_mode, cube_buffer.dtype, factors):
+        jit_result = downsample_cube_jit(
+            cube_buffer, factors, JIT_KERNEL_NAMES[interpolation_mode.name]
+        )
+    if jit_result is not None:
+        result = jit_result
+    elif interpolation_mode == InterpolationModes.MODE:
+        result = non_linear_filter_3d(cube_buffer, factors, _mode)
+    elif interpolation_mode == InterpolationModes.LABEL_MODE:
+        result = non_linear_filter_3d(cube_buffer, factors, _label_mode)
     elif interpolation_mode == InterpolationModes.MEDIAN:
-        return non_linear_filter_3d(cube_buffer, factors, _median)
+        result = non_linear_filter_3d(cube_buffer, factors, _median)
     elif interpolation_mode == InterpolationModes.NEAREST:
-        return linear_filter_3d(cube_buffer, factors, 0)
+        return linear_filter_3d(cube_buffer, factors, 0, out)
     elif interpolation_mode == InterpolationModes.BILINEAR:
-        return linear_filter_3d(cube_buffer, factors, 1)
+        return linear_filter_3d(cube_buffer, factors, 1, out)
     elif interpolation_mode == InterpolationModes.BICUBIC:
-        return linear_filter_3d(cube_buffer, factors, 2)
+        return linear_filter_3d(cube_buffer, factors, 2, out)
     elif interpolation_mode == InterpolationModes.MAX:
-        return non_linear_filter_3d(cube_buffer, factors, _max)
+        result = non_linear_filter_3d(cube_buffer, factors, _max)
     elif interpolation_mode == InterpolationModes.MIN:
-        return non_linear_filter_3d(cube_buffer, factors, _min)
+        result = non_linear_filter_3d(cube_buffer, factors, _min)
+    elif interpolation_mode == InterpolationModes.AVERAGE:
+        result = non_linear_filter_3d(cube_buffer, factors, _average)
     else:
         raise Exception("Invalid interpolation mode: {}".format(interpolation_mode))
 
-
-def downsample_unpadded_data(
-    buffer: np.ndarray, target_mag: Mag, interpolation_mode: InterpolationModes
-) -> np.ndarray:
-    logging.info(
-        f"Downsampling buffer of size {buffer.shape} to mag {target_mag.to_layer_name()}"
-    )
-    target_mag_np = np.array(target_mag.to_array())
-    current_dimension_size = np.array(buffer.shape[1:])
-    padding_size_for_downsampling = (
-        target_mag_np - (current_dimension_size % target_mag_np) % target_mag_np
-    )
-    padding_size_for_downsampling = list(zip([0, 0, 0], padding_size_for_downsampling))
-    buffer = np.pad(
-        buffer, pad_width=[(0, 0)] + padding_size_for_downsampling, mode="constant"
-    )
-    dimension_decrease = np.array([1] + target_mag.to_array())
-    downsampled_buffer_shape = np.array(buffer.shape) // dimension_decrease
-    downsampled_buffer = np.empty(dtype=buffer.dtype, shape=downsampled_buffer_shape)
-    for channel in range(buffer.shape[0]):
-        downsampled_buffer[channel] = downsample_cube(
-            buffer[channel], target_mag.to_array(), interpolation_mode
-        )
-    return downsampled_buffer
+    if out is None:
+        return result
+    out[...] = result
+    return out
 
 
 def downsample_mag(
@@ -495,7 +1789,10 @@ def downsample_mag(
     compress: bool = False,
     buffer_edge_len: int = None,
     args: Namespace = None,
-) -> None:
+    source_cube_addresses: List[Tuple[int, int, int]] = None,
+    keep_journal: bool = False,
+    selection: Dict[str, Any] = None,
+) -> List[Tuple[int, int, int]]:
     parsed_interpolation_mode = parse_interpolation_mode(interpolation_mode, layer_name)
 
     source_wkw_info = WkwDatasetInfo(path, layer_name, source_mag.to_layer_name(), None)
@@ -507,7 +1804,7 @@ def downsample_mag(
             wkw.Header(source.header.voxel_type),
         )
 
-    downsample(
+    return downsample(
         source_wkw_info,
         target_wkw_info,
         source_mag,
@@ -516,9 +1813,425 @@ def downsample_mag(
         compress,
         buffer_edge_len,
         args,
+        source_cube_addresses,
+        keep_journal,
+        selection,
+    )
+
+
+def downsample_mags_fused(
+    path: str,
+    layer_name: str,
+    source_mag: Mag,
+    target_mags: List[Mag],
+    interpolation_mode: str = "default",
+    compress: bool = False,
+    buffer_edge_len: int = None,
+    args: Namespace = None,
+    source_cube_addresses: List[Tuple[int, int, int]] = None,
+    keep_journal: bool = False,
+    incremental: bool = False,
+    selection: Dict[str, Any] = None,
+) -> List[Tuple[int, int, int]]:
+    parsed_interpolation_mode = parse_interpolation_mode(interpolation_mode, layer_name)
+
+    source_wkw_info = WkwDatasetInfo(path, layer_name, source_mag.to_layer_name(), None)
+    with open_wkw(source_wkw_info) as source:
+        target_wkw_infos = [
+            WkwDatasetInfo(
+                path,
+                layer_name,
+                target_mag.to_layer_name(),
+                wkw.Header(source.header.voxel_type),
+            )
+            for target_mag in target_mags
+        ]
+
+    return downsample_fused(
+        source_wkw_info,
+        target_wkw_infos,
+        source_mag,
+        target_mags,
+        parsed_interpolation_mode,
+        compress,
+        buffer_edge_len,
+        args,
+        source_cube_addresses,
+        keep_journal,
+        incremental,
+        selection,
     )
 
 
+def downsample_mags_pipelined(
+    path: str,
+    layer_name: str,
+    from_mag: Mag,
+    target_mags: List[Mag],
+    interpolation_mode: str,
+    compress: bool,
+    buffer_edge_len: int = None,
+    args: Namespace = None,
+    dirty_cube_addresses: List[Tuple[int, int, int]] = None,
+    source_cube_addresses: List[Tuple[int, int, int]] = None,
+    selection: Dict[str, Any] = None,
+) -> None:
+    """
+    Downsamples from_mag to all target_mags with a dependency-aware scheduler.
+    A target cube is ready as soon as all cubes of the previous mag which it is
+    computed from are finished, so that jobs of several mags are in flight at
+    once instead of waiting for the slowest job of every mag. Ready cubes are
+    submitted in full batches of cubes_per_job (see submit_ready_cubes).
+    Like in downsample, source_cube_addresses restricts the cubes of from_mag.
+    The journals of the mags are kept (see downsample_mag_sequence) and contain
+    the selection of a partial run (see describe_cube_selection).
+    """
+    parsed_interpolation_mode = parse_interpolation_mode(interpolation_mode, layer_name)
+    level_count = len(target_mags)
+    source_mags = [from_mag] + target_mags[:-1]
+    source_wkw_infos = [
+        WkwDatasetInfo(path, layer_name, source_mag.to_layer_name(), None)
+        for source_mag in source_mags
+    ]
+    with open_wkw(source_wkw_infos[0]) as source_wkw:
+        source_header = source_wkw.header
+    target_wkw_infos = [
+        WkwDatasetInfo(
+            path,
+            layer_name,
+            target_mag.to_layer_name(),
+            wkw.Header(source_header.voxel_type),
+        )
+        for target_mag in target_mags
+    ]
+    mag_factors_per_level = [
+        [t // s for (t, s) in zip(target_mag.to_array(), source_mag.to_array())]
+        for source_mag, target_mag in zip(source_mags, target_mags)
+    ]
+
+    # The target cubes of every mag and the number of cubes of the previous
+    # mag each of them depends on
+    if dirty_cube_addresses is not None:
+        source_cube_addresses = dirty_cube_addresses
+    elif source_cube_addresses is None:
+        source_cube_addresses = cube_addresses(source_wkw_infos[0])
+    target_cube_addresses_per_level = []
+    dependency_counts: List[Dict[Tuple[int, int, int], int]] = []
+    for mag_factors in mag_factors_per_level:
+        target_cube_addresses = get_target_cube_addresses(
+            source_cube_addresses, mag_factors
+        )
+        dependency_count: Dict[Tuple[int, int, int], int] = {}
+        for source_cube_xyz in source_cube_addresses:
+            target_cube_xyz = get_target_cube_address(source_cube_xyz, mag_factors)
+            dependency_count[target_cube_xyz] = (
+                dependency_count.get(target_cube_xyz, 0) + 1
+            )
+        target_cube_addresses_per_level.append(target_cube_addresses)
+        dependency_counts.append(dependency_count)
+        source_cube_addresses = target_cube_addresses
+    if len(target_cube_addresses_per_level[0]) == 0:
+        logging.info("Mag {} is empty, skipping all mags".format(from_mag))
+        return
+
+    buffer_edge_lens = []
+    for source_wkw_info, target_wkw_info, mag_factors in zip(
+        source_wkw_infos, target_wkw_infos, mag_factors_per_level
+    ):
+        create_target_wkw(source_wkw_info, target_wkw_info, compress)
+        plan = plan_downsampling(source_header, [mag_factors], buffer_edge_len, args)
+        buffer_edge_lens.append(plan.buffer_edge_len)
+        args = apply_downsampling_plan(plan, args)
+
+    journals = [
+        create_downsampling_journal(
+            target_wkw_info,
+            source_mag,
+            target_mag,
+            parsed_interpolation_mode,
+            compress,
+            selection,
+        )
+        for target_wkw_info, source_mag, target_mag in zip(
+            target_wkw_infos, source_mags, target_mags
+        )
+    ]
+    journaled_per_level = [journal.start() for journal in journals]
+    non_empty_per_level: List[Dict[Tuple[int, int, int], bool]] = [
+        {} for _ in range(level_count)
+    ]
+    # Target cubes of which at least one source cube contains data
+    with_data_per_level: List[Set[Tuple[int, int, int]]] = [
+        set() for _ in range(level_count)
+    ]
+    # Existing target cubes are recomputed even without source data, so that
+    # stale cubes are removed
+    existing_per_level = [
+        set(cube_addresses(target_wkw_info)) for target_wkw_info in target_wkw_infos
+    ]
+    ready_per_level: List[List[Tuple[int, int, int]]] = [[] for _ in range(level_count)]
+
+    voxel_count_per_cube = (source_header.file_len * source_header.block_len) ** 3
+    cube_count_per_log = math.ceil(
+        1024 ** 3 / voxel_count_per_cube
+    )  # log every gigavoxel of processed data
+    cubes_per_job_per_level = [
+        determine_cubes_per_job(
+            len(target_cube_addresses) - len(journaled), voxel_count_per_cube, args
+        )
+        for target_cube_addresses, journaled in zip(
+            target_cube_addresses_per_level, journaled_per_level
+        )
+    ]
+    submitted_cube_counts = [0] * level_count
+    # Target cubes of every mag which are not released yet
+    unreleased_counts = [
+        len(target_cube_addresses)
+        for target_cube_addresses in target_cube_addresses_per_level
+    ]
+
+    def finish_cube(
+        level: int, target_cube_xyz: Tuple[int, int, int], non_empty: bool
+    ) -> None:
+        non_empty_per_level[level][target_cube_xyz] = non_empty
+        target_cube_count = len(target_cube_addresses_per_level[level])
+        if len(non_empty_per_level[level]) == target_cube_count:
+            logging.info(
+                "Mag {} successfully cubed ({} of {} target cubes contain data)".format(
+                    target_mags[level],
+                    sum(non_empty_per_level[level].values()),
+                    target_cube_count,
+                )
+            )
+        if level + 1 == level_count:
+            return
+        next_cube_xyz = get_target_cube_address(
+            target_cube_xyz, mag_factors_per_level[level + 1]
+        )
+        if non_empty:
+            with_data_per_level[level + 1].add(next_cube_xyz)
+        dependency_counts[level + 1][next_cube_xyz] -= 1
+        if dependency_counts[level + 1][next_cube_xyz] == 0:
+            release_cube(level + 1, next_cube_xyz)
+
+    def release_cube(level: int, target_cube_xyz: Tuple[int, int, int]) -> None:
+        # All source cubes of the target cube are finished
+        unreleased_counts[level] -= 1
+        if target_cube_xyz in journaled_per_level[level]:
+            finish_cube(
+                level, target_cube_xyz, journaled_per_level[level][target_cube_xyz]
+            )
+        elif (
+            level == 0
+            or dirty_cube_addresses is not None
+            or target_cube_xyz in with_data_per_level[level]
+            or target_cube_xyz in existing_per_level[level]
+        ):
+            ready_per_level[level].append(target_cube_xyz)
+        else:
+            # Like downsample, target cubes without any source data are skipped
+            # (dirty and existing cubes are always recomputed to remove stale files)
+            finish_cube(level, target_cube_xyz, False)
+
+    with get_executor_for_args(args) as executor:
+        jobs: Dict[Future, Tuple[int, List[Tuple[int, int, int]]]] = {}
+
+        def submit_ready_cubes() -> None:
+            # The ready cubes of all mags are submitted at once (e.g., as a single
+            # slurm array job). As long as more cubes of a mag can become ready,
+            # only full batches are submitted and the rest waits for them.
+            job_args = []
+            job_batches = []
+            for level in range(level_count):
+                cubes_per_job = cubes_per_job_per_level[level]
+                ready_cubes = ready_per_level[level]
+                if unreleased_counts[level] > 0:
+                    submit_count = len(ready_cubes) // cubes_per_job * cubes_per_job
+                else:
+                    submit_count = len(ready_cubes)
+                for target_cube_batch in get_chunks(
+                    ready_cubes[:submit_count], cubes_per_job
+                ):
+                    first_index = submitted_cube_counts[level]
+                    submitted_cube_counts[level] += len(target_cube_batch)
+                    use_logging = any(
+                        index % cube_count_per_log == 0
+                        for index in range(first_index, submitted_cube_counts[level])
+                    )
+                    job_args.append(
+                        (
+                            source_wkw_infos[level],
+                            target_wkw_infos[level],
+                            mag_factors_per_level[level],
+                            parsed_interpolation_mode,
+                            target_cube_batch,
+                            buffer_edge_lens[level],
+                            compress,
+                            use_logging,
+                        )
+                    )
+                    job_batches.append((level, target_cube_batch))
+                ready_per_level[level] = ready_cubes[submit_count:]
+            if len(job_args) > 0:
+                futures = executor.map_to_futures(downsample_cubes_job, job_args)
+                jobs.update(zip(futures, job_batches))
+
+        try:
+            for target_cube_xyz in target_cube_addresses_per_level[0]:
+                release_cube(0, target_cube_xyz)
+            submit_ready_cubes()
+            while len(jobs) > 0:
+                done_jobs, _ = wait(list(jobs), return_when=FIRST_COMPLETED)
+                for future in done_jobs:
+                    level, target_cube_batch = jobs.pop(future)
+                    for target_cube_xyz, non_empty in zip(
+                        target_cube_batch, future.result()
+                    ):
+                        journals[level].record(target_cube_xyz, non_empty)
+                        finish_cube(level, target_cube_xyz, non_empty)
+                    journals[level].flush()
+                submit_ready_cubes()
+            assert all(
+                len(ready_cubes) == 0 for ready_cubes in ready_per_level
+            ), "Not all target cubes were downsampled"
+        finally:
+            for journal in journals:
+                journal.close()
+
+
+def downsample_mag_sequence(
+    path: str,
+    layer_name: str,
+    from_mag: Mag,
+    target_mags: List[Mag],
+    interpolation_mode: str,
+    compress: bool,
+    buffer_edge_len: int = None,
+    args: Namespace = None,
+    mags_per_job: int = 1,
+    dirty_cube_addresses: List[Tuple[int, int, int]] = None,
+    bbox: BoundingBox = None,
+) -> None:
+    """
+    Downsamples from_mag to all target_mags, either with single mag jobs which
+    are scheduled by their dependencies or one batch of mags_per_job fused mags
+    after another. If dirty_cube_addresses (cubes of from_mag) is passed, only
+    the target cubes derived from these cubes are recomputed. Recomputed cubes
+    which became empty are removed in every run. If bbox (in mag 1 coordinates) is passed, only
+    the target cubes which intersect it are downsampled (outside of the cubes
+    of the previous mag which intersect it, their data may be incomplete on a
+    dataset which was not downsampled before, otherwise the existing cubes of
+    the previous mag are used).
+    The journals of the finished mags are kept until all mags are finished, so
+    that a restarted run skips the finished mags and cubes (unless it selects
+    other cubes).
+    """
+    selection = describe_cube_selection(dirty_cube_addresses, bbox)
+    source_mag = from_mag
+    # Only the target cubes derived from the source cubes are recomputed
+    source_cube_addresses = dirty_cube_addresses
+    if bbox is not None:
+        # The target cubes which intersect the bounding box are exactly the ones
+        # derived from the source cubes which intersect it
+        source_wkw_info = WkwDatasetInfo(
+            path, layer_name, from_mag.to_layer_name(), None
+        )
+        bbox_cube_addresses = get_bounding_box_cube_addresses(
+            source_wkw_info, from_mag, bbox
+        )
+        if dirty_cube_addresses is not None:
+            dirty_cube_addresses = [
+                xyz for xyz in dirty_cube_addresses if xyz in bbox_cube_addresses
+            ]
+            source_cube_addresses = dirty_cube_addresses
+        else:
+            source_cube_addresses = [
+                xyz
+                for xyz in cube_addresses(source_wkw_info)
+                if xyz in bbox_cube_addresses
+            ]
+        logging.info(
+            "Downsampling the {} cubes of mag {} which intersect {}".format(
+                len(source_cube_addresses), from_mag, bbox
+            )
+        )
+    if dirty_cube_addresses is not None:
+        logging.info(
+            "Recomputing the cubes affected by {} dirty cubes of mag {}".format(
+                len(dirty_cube_addresses), from_mag
+            )
+        )
+    if mags_per_job <= 1:
+        # Without fused jobs, the cubes of all mags are scheduled at once
+        downsample_mags_pipelined(
+            path,
+            layer_name,
+            from_mag,
+            target_mags,
+            interpolation_mode,
+            compress,
+            buffer_edge_len,
+            args,
+            dirty_cube_addresses,
+            source_cube_addresses,
+            selection,
+        )
+    else:
+        if source_cube_addresses is None:
+            source_cube_addresses = cube_addresses(
+                WkwDatasetInfo(path, layer_name, from_mag.to_layer_name(), None)
+            )
+        for target_mag_batch in get_chunks(target_mags, mags_per_job):
+            if len(target_mag_batch) == 1:
+                downsample_mag(
+                    path,
+                    layer_name,
+                    source_mag,
+                    target_mag_batch[0],
+                    interpolation_mode,
+                    compress,
+                    buffer_edge_len,
+                    args,
+                    source_cube_addresses,
+                    keep_journal=True,
+                    selection=selection,
+                )
+            else:
+                downsample_mags_fused(
+                    path,
+                    layer_name,
+                    source_mag,
+                    target_mag_batch,
+                    interpolation_mode,
+                    compress,
+                    buffer_edge_len,
+                    args,
+                    source_cube_addresses,
+                    keep_journal=True,
+                    incremental=selection is not None,
+                    selection=selection,
+                )
+            # All recomputed cubes are the source cubes of the next mag, even if
+            # they are empty now, so that the stale cubes which they belong to are
+            # recomputed (or removed) too
+            source_cube_addresses = get_target_cube_addresses(
+                source_cube_addresses,
+                [
+                    t // s
+                    for (t, s) in zip(
+                        target_mag_batch[-1].to_array(), source_mag.to_array()
+                    )
+                ],
+            )
+            source_mag = target_mag_batch[-1]
+
+    # All mags are finished, so that the journals are not needed anymore
+    for target_mag in target_mags:
+        DownsamplingJournal(
+            WkwDatasetInfo(path, layer_name, target_mag.to_layer_name(), None), {}
+        ).remove()
+
+
 def parse_interpolation_mode(
     interpolation_mode: str, layer_name: str
 ) -> InterpolationModes:
@@ -526,7 +2239,7 @@ def parse_interpolation_mode(
         return (
             InterpolationModes.MEDIAN
             if layer_name == "color"
-            else InterpolationModes.MODE
+            else InterpolationModes.LABEL_MODE
         )
     else:
         return InterpolationModes[interpolation_mode.upper()]
@@ -542,6 +2255,9 @@ def downsample_mags(
     compress: bool = True,
     args: Namespace = None,
     anisotropic: bool = True,
+    mags_per_job: int = 1,
+    dirty_cube_addresses: List[Tuple[int, int, int]] = None,
+    bbox: BoundingBox = None,
 ) -> None:
     assert layer_name and from_mag or not layer_name and not from_mag, (
         "You provided only one of the following "
@@ -580,6 +2296,9 @@ def downsample_mags(
             compress,
             buffer_edge_len,
             args,
+            mags_per_job,
+            dirty_cube_addresses,
+            bbox,
         )
     else:
         downsample_mags_isotropic(
@@ -591,6 +2310,9 @@ def downsample_mags(
             compress,
             buffer_edge_len,
             args,
+            mags_per_job,
+            dirty_cube_addresses,
+            bbox,
         )
 
 
@@ -603,22 +2325,30 @@ def downsample_mags_isotropic(
     compress: bool,
     buffer_edge_len: int = None,
     args: Namespace = None,
+    mags_per_job: int = 1,
+    dirty_cube_addresses: List[Tuple[int, int, int]] = None,
+    bbox: BoundingBox = None,
 ) -> None:
 
+    target_mags = []
     target_mag = from_mag.scaled_by(2)
     while target_mag <= max_mag:
-        source_mag = target_mag.divided_by(2)
-        downsample_mag(
-            path,
-            layer_name,
-            source_mag,
-            target_mag,
-            interpolation_mode,
-            compress,
-            buffer_edge_len,
-            args,
-        )
-        target_mag.scale_by(2)
+        target_mags.append(target_mag)
+        target_mag = target_mag.scaled_by(2)
+
+    downsample_mag_sequence(
+        path,
+        layer_name,
+        from_mag,
+        target_mags,
+        interpolation_mode,
+        compress,
+        buffer_edge_len,
+        args,
+        mags_per_job,
+        dirty_cube_addresses,
+        bbox,
+    )
 
 
 def downsample_mags_anisotropic(
@@ -631,25 +2361,31 @@ def downsample_mags_anisotropic(
     compress: bool,
     buffer_edge_len: int = None,
     args: Namespace = None,
+    mags_per_job: int = 1,
+    dirty_cube_addresses: List[Tuple[int, int, int]] = None,
+    bbox: BoundingBox = None,
 ) -> None:
 
-    prev_mag = from_mag
+    target_mags = []
     target_mag = get_next_anisotropic_mag(from_mag, scale)
     while target_mag <= max_mag:
-        source_mag = prev_mag
-        downsample_mag(
-            path,
-            layer_name,
-            source_mag,
-            target_mag,
-            interpolation_mode,
-            compress,
-            buffer_edge_len,
-            args,
-        )
-        prev_mag = target_mag
+        target_mags.append(target_mag)
         target_mag = get_next_anisotropic_mag(target_mag, scale)
 
+    downsample_mag_sequence(
+        path,
+        layer_name,
+        from_mag,
+        target_mags,
+        interpolation_mode,
+        compress,
+        buffer_edge_len,
+        args,
+        mags_per_job,
+        dirty_cube_addresses,
+        bbox,
+    )
+
 
 def get_next_anisotropic_mag(mag: Mag, scale: Tuple[float, float, float]) -> Mag:
     max_index, min_index = detect_larger_and_smaller_dimension(scale)
@@ -686,6 +2422,17 @@ if __name__ == "__main__":
 
     from_mag = Mag(args.from_mag)
     max_mag = Mag(args.max)
+    dirty_cube_addresses = args.dirty_cubes
+    if args.dirty_bbox is not None:
+        dirty_cube_addresses = (dirty_cube_addresses or []) + sorted(
+            get_bounding_box_cube_addresses(
+                WkwDatasetInfo(
+                    args.path, args.layer_name, from_mag.to_layer_name(), None
+                ),
+                from_mag,
+                args.dirty_bbox,
+            )
+        )
     if args.anisotropic_target_mag:
         anisotropic_target_mag = Mag(args.anisotropic_target_mag)
 
@@ -701,6 +2448,9 @@ if __name__ == "__main__":
             not args.no_compress,
             args.buffer_cube_size,
             args,
+            args.mags_per_job,
+            dirty_cube_addresses,
+            args.bbox,
         )
     elif not args.isotropic:
         try:
@@ -722,6 +2472,9 @@ if __name__ == "__main__":
             args.interpolation_mode,
             not args.no_compress,
             args=args,
+            mags_per_job=args.mags_per_job,
+            dirty_cube_addresses=dirty_cube_addresses,
+            bbox=args.bbox,
         )
     else:
         downsample_mags_isotropic(
@@ -733,6 +2486,9 @@ if __name__ == "__main__":
             not args.no_compress,
             args.buffer_cube_size,
             args,
+            args.mags_per_job,
+            dirty_cube_addresses,
+            args.bbox,
         )
 
     refresh_metadata(args.path)
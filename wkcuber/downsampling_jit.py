@@ -0,0 +1,169 @@
+"""
+JIT-compiled mode, median and average kernels, which are available if numba
+is installed.
+
+The kernels loop over the blocks of the buffer and compute every output voxel
+from a small vote buffer, so that no temporaries of the size of the buffer
+are allocated. They compute exactly the same results as the NumPy filters in
+wkcuber.downsampling, which are used for all other cases.
+"""
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+try:
+    import numba
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# Maps the kernel names to the compiled block filters (if numba is available)
+BLOCK_FILTERS: Dict[str, Callable] = {}
+
+
+def is_supported(kernel_name: str, dtype: np.dtype) -> bool:
+    if kernel_name not in BLOCK_FILTERS:
+        return False
+    if kernel_name == "mode":
+        # Floats are left to NumPy because of the NaN semantics
+        return np.issubdtype(dtype, np.integer)
+    # The NumPy filters compute floats and signed integers via float64
+    return np.issubdtype(dtype, np.unsignedinteger)
+
+
+def downsample_cube_jit(
+    cube_buffer: np.ndarray, factors: List[int], kernel_name: str
+) -> Optional[np.ndarray]:
+    """
+    Downsamples a buffer of shape (x, y, z) or (channels, x, y, z) with the
+    given kernel. Returns None if the kernel does not support the buffer.
+    """
+    if not is_supported(kernel_name, cube_buffer.dtype):
+        return None
+    if cube_buffer.ndim == 4:
+        return np.stack(
+            [_filter_cube(channel, factors, kernel_name) for channel in cube_buffer]
+        )
+    return _filter_cube(cube_buffer, factors, kernel_name)
+
+
+def _filter_cube(data: np.ndarray, factors: List[int], kernel_name: str) -> np.ndarray:
+    if data.strides[0] < data.strides[-1]:
+        # Loop over the C-ordered view (e.g., of wkw's fortran-ordered buffers)
+        return _filter_cube(data.T, factors[::-1], kernel_name).T
+
+    out = np.empty(
+        tuple(size // factor for size, factor in zip(data.shape, factors)),
+        dtype=data.dtype,
+    )
+    BLOCK_FILTERS[kernel_name](data, factors[0], factors[1], factors[2], out)
+    return out
+
+
+if NUMBA_AVAILABLE:
+
+    @numba.njit(nogil=True, cache=True)
+    def _sort(votes: np.ndarray) -> None:
+        # Insertion sort, which is fast for the few votes of a block
+        for i in range(1, len(votes)):
+            value = votes[i]
+            j = i - 1
+            while j >= 0 and votes[j] > value:
+                votes[j + 1] = votes[j]
+                j -= 1
+            votes[j + 1] = value
+
+    @numba.njit(nogil=True, cache=True)
+    def _mode(votes: np.ndarray) -> np.generic:
+        # The longest run of the sorted votes, the smallest value on ties
+        _sort(votes)
+        best_value = votes[0]
+        best_count = 0
+        run_start = 0
+        for i in range(1, len(votes) + 1):
+            if i == len(votes) or votes[i] != votes[run_start]:
+                if i - run_start > best_count:
+                    best_count = i - run_start
+                    best_value = votes[run_start]
+                run_start = i
+        return best_value
+
+    @numba.njit(nogil=True, cache=True)
+    def _median(votes: np.ndarray) -> np.uint64:
+        # The floored mean of the middle votes like the NumPy filter
+        _sort(votes)
+        lower = np.uint64(votes[(len(votes) - 1) // 2])
+        upper = np.uint64(votes[len(votes) // 2])
+        return lower + (upper - lower) // np.uint64(2)
+
+    @numba.njit(nogil=True, cache=True)
+    def _average(votes: np.ndarray) -> np.uint64:
+        # Rounded half up like the NumPy filter. sum(vote) // n and
+        # sum(vote) % n are accumulated separately to avoid overflows.
+        vote_count = np.uint64(len(votes))
+        quotient = np.uint64(0)
+        remainder = np.uint64(0)
+        for vote in votes:
+            quotient += np.uint64(vote) // vote_count
+            remainder += np.uint64(vote) % vote_count
+        return quotient + (remainder + vote_count // np.uint64(2)) // vote_count
+
+    @numba.njit(nogil=True, cache=True)
+    def _gather_votes(
+        data: np.ndarray,
+        x: int,
+        y: int,
+        z: int,
+        factor_x: int,
+        factor_y: int,
+        factor_z: int,
+        votes: np.ndarray,
+    ) -> None:
+        i = 0
+        for dx in range(factor_x):
+            for dy in range(factor_y):
+                row = data[x * factor_x + dx, y * factor_y + dy]
+                for dz in range(factor_z):
+                    votes[i] = row[z * factor_z + dz]
+                    i += 1
+
+    # numba cannot pass the vote filter as an argument without losing the
+    # inlining, so that every filter has its own loop over the blocks
+
+    @numba.njit(nogil=True, cache=True)
+    def _mode_blocks(
+        data: np.ndarray, factor_x: int, factor_y: int, factor_z: int, out: np.ndarray
+    ) -> None:
+        votes = np.empty(factor_x * factor_y * factor_z, dtype=data.dtype)
+        for x in range(out.shape[0]):
+            for y in range(out.shape[1]):
+                for z in range(out.shape[2]):
+                    _gather_votes(data, x, y, z, factor_x, factor_y, factor_z, votes)
+                    out[x, y, z] = _mode(votes)
+
+    @numba.njit(nogil=True, cache=True)
+    def _median_blocks(
+        data: np.ndarray, factor_x: int, factor_y: int, factor_z: int, out: np.ndarray
+    ) -> None:
+        votes = np.empty(factor_x * factor_y * factor_z, dtype=data.dtype)
+        for x in range(out.shape[0]):
+            for y in range(out.shape[1]):
+                for z in range(out.shape[2]):
+                    _gather_votes(data, x, y, z, factor_x, factor_y, factor_z, votes)
+                    out[x, y, z] = _median(votes)
+
+    @numba.njit(nogil=True, cache=True)
+    def _average_blocks(
+        data: np.ndarray, factor_x: int, factor_y: int, factor_z: int, out: np.ndarray
+    ) -> None:
+        votes = np.empty(factor_x * factor_y * factor_z, dtype=data.dtype)
+        for x in range(out.shape[0]):
+            for y in range(out.shape[1]):
+                for z in range(out.shape[2]):
+                    _gather_votes(data, x, y, z, factor_x, factor_y, factor_z, votes)
+                    out[x, y, z] = _average(votes)
+
+    BLOCK_FILTERS.update(
+        {"mode": _mode_blocks, "median": _median_blocks, "average": _average_blocks}
+    )
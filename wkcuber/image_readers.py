@@ -1,4 +1,4 @@
-from typing import Tuple, Dict, Union
+from typing import Tuple, Dict, List, Optional, Union
 
 import numpy as np
 import logging
@@ -7,15 +7,72 @@ from PIL import Image
 
 from .vendor.dm3 import DM3
 from .vendor.dm4 import DM4File, DM4TagHeader
-from tifffile import TiffFile
+from tifffile import TiffFile, TiffPage
 
 # Disable PIL's maximum image limit.
 Image.MAX_IMAGE_PIXELS = None
 
+# The TIFF compressions whose segments are decoded with the JPEG tables
+JPEG_COMPRESSIONS = (6, 7, 33007, 34892)
+
+
+def assert_region_in_image(
+    file_name: str,
+    dimensions: Tuple[int, int],
+    x_range: Tuple[int, int],
+    y_range: Tuple[int, int],
+) -> None:
+    assert (
+        0 <= x_range[0] <= x_range[1] <= dimensions[0]
+        and 0 <= y_range[0] <= y_range[1] <= dimensions[1]
+    ), "Image {} with the dimensions {} does not contain the region x={} y={}.".format(
+        file_name, dimensions, x_range, y_range
+    )
+
 
 class ImageReader:
     def read_array(self, file_name: str, dtype: np.dtype, z_slice: int) -> np.ndarray:
-        pass
+        raise NotImplementedError()
+
+    def read_region(
+        self,
+        file_name: str,
+        dtype: np.dtype,
+        z_slice: int,
+        x_range: Tuple[int, int],
+        y_range: Tuple[int, int],
+    ) -> np.ndarray:
+        # Decodes the whole image and crops the region
+        image = self.read_array(file_name, dtype, z_slice)
+        assert_region_in_image(
+            file_name, (image.shape[0], image.shape[1]), x_range, y_range
+        )
+        return image[x_range[0] : x_range[1], y_range[0] : y_range[1]]
+
+    def read_array_into(
+        self,
+        file_name: str,
+        z_slice: int,
+        out: np.ndarray,
+        offset: Tuple[int, int] = (0, 0),
+    ) -> Tuple[int, int]:
+        # out has the shape (channel_count, width, height) and the target dtype
+        x, y = offset
+        region = self.read_region(
+            file_name,
+            out.dtype,
+            z_slice,
+            (x, x + out.shape[1]),
+            (y, y + out.shape[2]),
+        )
+        region = region.reshape(region.shape[0:2] + (-1,))
+        assert (
+            region.shape[2] == out.shape[0]
+        ), "Image {} has {} channels, but {} were expected.".format(
+            file_name, region.shape[2], out.shape[0]
+        )
+        out[...] = region.transpose(2, 0, 1)
+        return self.read_dimensions(file_name)
 
     def read_dimensions(self, file_name: str) -> Tuple[int, int]:
         pass
@@ -36,6 +93,24 @@ class PillowImageReader(ImageReader):
         this_layer = this_layer.reshape(this_layer.shape + (1,))
         return this_layer
 
+    def read_region(
+        self,
+        file_name: str,
+        dtype: np.dtype,
+        z_slice: int,
+        x_range: Tuple[int, int],
+        y_range: Tuple[int, int],
+    ) -> np.ndarray:
+        with Image.open(file_name) as image:
+            assert_region_in_image(file_name, image.size, x_range, y_range)
+            if (x_range, y_range) != ((0, image.width), (0, image.height)):
+                # The image is decoded as a whole, but only the region is
+                # converted to an array
+                image = image.crop((x_range[0], y_range[0], x_range[1], y_range[1]))
+            # A read-only view with the shape (y, x) or (y, x, channel_count)
+            data = np.asarray(image)
+        return data.swapaxes(0, 1).astype(dtype, copy=False)
+
     def read_dimensions(self, file_name: str) -> Tuple[int, int]:
         with Image.open(file_name) as test_img:
             return test_img.width, test_img.height
@@ -133,40 +208,163 @@ def find_count_of_axis(tif_file: TiffFile, axis: str) -> int:
         return tif_series.shape[index]  # pylint: disable=unsubscriptable-object
 
 
+def read_page_dimensions(page: TiffPage) -> Tuple[int, int]:
+    return page.shape[page.axes.find("X")], page.shape[page.axes.find("Y")]
+
+
+def memmap_page(page: TiffPage) -> Optional[np.ndarray]:
+    """
+    Returns a read-only memory map of the page data with the shape of the page
+    if it is stored uncompressed and contiguously, else None. Slicing the map
+    only reads the required rows from disk.
+    """
+    if not page.is_memmappable:
+        return None
+    return page.parent.filehandle.memmap_array(
+        page.parent.byteorder + page.dtype.char, page.shape, page.dataoffsets[0]
+    )
+
+
+def read_page_region(
+    page: TiffPage, x_range: Tuple[int, int], y_range: Tuple[int, int], out: np.ndarray
+) -> None:
+    """
+    Reads the region of the page into out, which has the (y, x) shape of the
+    region. Uncompressed pages are copied from a memory map, and only the tiles
+    or strips of other two-dimensional pages which intersect the region are
+    read and decoded.
+    """
+    x_start, x_end = x_range
+    y_start, y_end = y_range
+    width, height = read_page_dimensions(page)
+    data = memmap_page(page)
+    if data is None and page.axes != "YX":
+        # E.g., pages with samples, which are decoded as a whole
+        data = page.asarray()
+    if data is not None:
+        data = np.transpose(data, (page.axes.find("Y"), page.axes.find("X")))
+        out[...] = data[y_start:y_end, x_start:x_end]
+        return
+    if (
+        (x_range, y_range) == ((0, width), (0, height))
+        and out.dtype == page.dtype
+        and out.flags.c_contiguous
+    ):
+        # The whole page is decoded into out without any copy (e.g., a section
+        # of an unpadded fortran-ordered batch buffer)
+        page.asarray(out=out)
+        return
+
+    keyframe = page.keyframe
+    if keyframe.is_tiled:
+        segment_width, segment_length = keyframe.tilewidth, keyframe.tilelength
+    else:
+        segment_width, segment_length = width, keyframe.rowsperstrip
+    segments_per_row = -(-width // segment_width)
+    indices = [
+        row * segments_per_row + column
+        for row in range(y_start // segment_length, -(-y_end // segment_length))
+        for column in range(x_start // segment_width, -(-x_end // segment_width))
+    ]
+    decode_args = {}
+    if keyframe.compression in JPEG_COMPRESSIONS:
+        decode_args["jpegtables"] = page.jpegtables
+        # Older versions of tifffile do not decode with separate JPEG headers
+        if hasattr(keyframe, "jpegheader"):
+            decode_args["jpegheader"] = keyframe.jpegheader
+    # The segments are read in the order of their offsets and yielded with
+    # their position in indices
+    for data, position in page.parent.filehandle.read_segments(
+        [page.dataoffsets[index] for index in indices],
+        [page.databytecounts[index] for index in indices],
+    ):
+        # The segment has the shape (depth, length, width, samples) and is at
+        # (sample, depth, y, x, sample) of the page
+        segment, (_, _, y, x, _), shape = keyframe.decode(
+            data, indices[position], **decode_args
+        )
+        top, bottom = max(y, y_start), min(y + shape[1], y_end)
+        left, right = max(x, x_start), min(x + shape[2], x_end)
+        target = out[top - y_start : bottom - y_start, left - x_start : right - x_start]
+        if segment is None:
+            # Empty segments are not stored
+            target[...] = 0
+        else:
+            target[...] = segment[0, top - y : bottom - y, left - x : right - x, 0]
+
+
+def read_pages_region(
+    pages: List[TiffPage],
+    dtype: np.dtype,
+    x_range: Tuple[int, int],
+    y_range: Tuple[int, int],
+) -> np.ndarray:
+    # Every channel has the (y, x) shape of the pages, so that each page is
+    # read into it directly
+    data = np.empty(
+        (len(pages), y_range[1] - y_range[0], x_range[1] - x_range[0]), dtype
+    )
+    for channel, page in zip(data, pages):
+        read_page_region(page, x_range, y_range, channel)
+    # transpose data to shape(x, y, channel_count)
+    return data.transpose(2, 1, 0)
+
+
 class TiffImageReader(ImageReader):
     def read_array(self, file_name: str, dtype: np.dtype, z_slice: int) -> np.ndarray:
         with TiffFile(file_name) as tif_file:
-            num_channels = self.read_channel_count(file_name)
-            if len(tif_file.pages) > num_channels:
-                data = np.array(
-                    list(
-                        map(
-                            lambda x: x.asarray(),
-                            tif_file.pages[
-                                z_slice * num_channels : z_slice * num_channels
-                                + num_channels
-                            ],
-                        )
-                    ),
-                    dtype,
-                )
-            else:
-                data = np.array(
-                    list(map(lambda x: x.asarray(), tif_file.pages[0:num_channels])),
-                    dtype,
-                )
-            # transpose data to shape(x, y, channel_count)
-            data = np.transpose(
-                data,
-                (
-                    tif_file.pages[0].axes.find("X") + 1,
-                    tif_file.pages[0].axes.find("Y") + 1,
-                    0,
-                ),
-            )
+            pages = self._read_channel_pages(tif_file, z_slice)
+            width, height = read_page_dimensions(pages[0])
+            data = read_pages_region(pages, dtype, (0, width), (0, height))
             data = data.reshape(data.shape + (1,))
             return data
 
+    def _read_channel_pages(self, tif_file: TiffFile, z_slice: int) -> List[TiffPage]:
+        num_channels = find_count_of_axis(tif_file, "C")
+        if len(tif_file.pages) > num_channels:
+            return tif_file.pages[
+                z_slice * num_channels : z_slice * num_channels + num_channels
+            ]
+        return tif_file.pages[0:num_channels]
+
+    def read_region(
+        self,
+        file_name: str,
+        dtype: np.dtype,
+        z_slice: int,
+        x_range: Tuple[int, int],
+        y_range: Tuple[int, int],
+    ) -> np.ndarray:
+        with TiffFile(file_name) as tif_file:
+            pages = self._read_channel_pages(tif_file, z_slice)
+            assert_region_in_image(
+                file_name, read_page_dimensions(pages[0]), x_range, y_range
+            )
+            return read_pages_region(pages, dtype, x_range, y_range)
+
+    def read_array_into(
+        self,
+        file_name: str,
+        z_slice: int,
+        out: np.ndarray,
+        offset: Tuple[int, int] = (0, 0),
+    ) -> Tuple[int, int]:
+        with TiffFile(file_name) as tif_file:
+            pages = self._read_channel_pages(tif_file, z_slice)
+            dimensions = read_page_dimensions(pages[0])
+            x_range = (offset[0], offset[0] + out.shape[1])
+            y_range = (offset[1], offset[1] + out.shape[2])
+            assert_region_in_image(file_name, dimensions, x_range, y_range)
+            assert (
+                len(pages) == out.shape[0]
+            ), "Image {} has {} channels, but {} were expected.".format(
+                file_name, len(pages), out.shape[0]
+            )
+            for channel, page in zip(out, pages):
+                # The transposed channel has the shape (y, x) of the page
+                read_page_region(page, x_range, y_range, channel.T)
+            return dimensions
+
     def read_dimensions(self, file_name: str) -> Tuple[int, int]:
         with TiffFile(file_name) as tif_file:
             return find_count_of_axis(tif_file, "X"), find_count_of_axis(tif_file, "Y")
@@ -206,6 +404,43 @@ class ImageReaderManager:
 
         return image
 
+    def read_region(
+        self,
+        file_name: str,
+        dtype: np.dtype,
+        z_slice: int,
+        x_range: Tuple[int, int],
+        y_range: Tuple[int, int],
+    ) -> np.ndarray:
+        """
+        Reads the region x_range x y_range (start inclusive, end exclusive) of
+        the image. Tiled or striped TIFFs only decode the tiles or strips of
+        the region, other formats decode the whole image.
+        """
+        _, ext = path.splitext(file_name)
+
+        region = self.readers[ext].read_region(
+            file_name, dtype, z_slice, x_range, y_range
+        )
+        # Standardize the region shape to (x, y, channel_count, z=1)
+        return region.reshape(region.shape[0:2] + (-1, 1))
+
+    def read_array_into(
+        self,
+        file_name: str,
+        z_slice: int,
+        out: np.ndarray,
+        offset: Tuple[int, int] = (0, 0),
+    ) -> Tuple[int, int]:
+        """
+        Reads the region of the image at offset (x, y) into out, which has the
+        shape (channel_count, width, height) and the target dtype (e.g., a
+        section of a batch buffer of wkw's shape). Returns the dimensions of
+        the whole image.
+        """
+        _, ext = path.splitext(file_name)
+        return self.readers[ext].read_array_into(file_name, z_slice, out, offset)
+
     def read_dimensions(self, file_name: str) -> Tuple[int, int]:
         _, ext = path.splitext(file_name)
         return self.readers[ext].read_dimensions(file_name)
@@ -17,6 +17,7 @@ from .utils import (
     setup_logging,
     get_executor_for_args,
     wait_and_ensure_success,
+    morton_code,
 )
 
 
@@ -124,10 +125,15 @@ def recube(
         outer_bounding_box_br[2] - outer_bounding_box_tl[2],
     ]
 
-    target_cube_addresses = product(
-        range(0, outer_bounding_box_size[0], wkw_cube_size),
-        range(0, outer_bounding_box_size[1], wkw_cube_size),
-        range(0, outer_bounding_box_size[2], wkw_cube_size),
+    target_cube_addresses = sorted(
+        product(
+            range(0, outer_bounding_box_size[0], wkw_cube_size),
+            range(0, outer_bounding_box_size[1], wkw_cube_size),
+            range(0, outer_bounding_box_size[2], wkw_cube_size),
+        ),
+        key=lambda xyz: morton_code(
+            (xyz[0] // wkw_cube_size, xyz[1] // wkw_cube_size, xyz[2] // wkw_cube_size)
+        ),
     )
 
     with get_executor_for_args(args) as executor:
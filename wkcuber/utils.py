@@ -14,11 +14,24 @@ import psutil
 import traceback
 from cluster_tools.schedulers.cluster_executor import ClusterExecutor
 
-from typing import List, Tuple, Union, Iterable, Generator, Any, Optional, Type
+from typing import (
+    List,
+    Tuple,
+    Union,
+    Iterable,
+    Iterator,
+    Generator,
+    Any,
+    Optional,
+    Type,
+    Callable,
+    TypeVar,
+    Deque,
+)
 from glob import iglob
-from collections import namedtuple
+from collections import namedtuple, deque
 from multiprocessing import cpu_count
-from concurrent.futures import as_completed
+from concurrent.futures import as_completed, ThreadPoolExecutor
 from os import path, getpid
 from math import floor, ceil
 from logging import getLogger
@@ -58,13 +71,54 @@ def ensure_wkw(target_wkw_info: WkwDatasetInfo) -> None:
 
 
 def cube_addresses(source_wkw_info: WkwDatasetInfo) -> List[Tuple[int, int, int]]:
-    # Gathers all WKW cubes in the dataset
+    # Gathers all WKW cubes in the dataset (in morton order)
     with open_wkw(source_wkw_info) as source_wkw:
         wkw_addresses = list(parse_cube_file_name(f) for f in source_wkw.list_files())
-        wkw_addresses.sort()
+        wkw_addresses.sort(key=morton_code)
         return wkw_addresses
 
 
+def morton_code(xyz: Tuple[int, int, int]) -> int:
+    """
+    Interleaves the bits of the (non-negative) coordinates. Sorting cube addresses
+    by their morton code (z-order curve) keeps cubes which are processed one after
+    another spatially close, so that concurrent jobs read clustered files.
+    """
+    code = 0
+    for bit in range(max(dim.bit_length() for dim in xyz)):
+        for axis, dim in enumerate(xyz):
+            code |= ((dim >> bit) & 1) << (3 * bit + axis)
+    return code
+
+
+def bounding_box_cube_addresses(
+    dataset: wkw.Dataset, bbox: BoundingBox
+) -> List[Tuple[int, int, int]]:
+    # Gathers the addresses of all WKW cubes which intersect the bounding box
+    # (in voxel coordinates of the dataset), whether they exist or not
+    if bbox.is_empty():
+        return []
+    cube_length = dataset.header.file_len * dataset.header.block_len
+    start = bbox.topleft // cube_length
+    end = (bbox.bottomright - 1) // cube_length + 1
+    return [
+        (x, y, z)
+        for z in range(start[2], end[2])
+        for y in range(start[1], end[1])
+        for x in range(start[0], end[0])
+    ]
+
+
+def parse_cube_address(cube_address: str) -> Tuple[int, int, int]:
+    try:
+        x, y, z = (int(dim) for dim in cube_address.split(","))
+        return (x, y, z)
+    except Exception as e:
+        raise argparse.ArgumentTypeError(
+            "The cube address could not be parsed (expected x,y,z)"
+        ) from e
+
+
 def parse_cube_file_name(filename: str) -> Tuple[int, int, int]:
     m = CUBE_REGEX.search(filename)
     if m is None:
@@ -72,6 +126,13 @@ def parse_cube_file_name(filename: str) -> Tuple[int, int, int]:
     return int(m.group(3)), int(m.group(2)), int(m.group(1))
 
 
+def cube_file_path(dataset: wkw.Dataset, cube_xyz: Tuple[int, int, int]) -> str:
+    x, y, z = cube_xyz
+    return path.join(
+        dataset.root, "z{}".format(z), "y{}".format(y), "x{}.wkw".format(x)
+    )
+
+
 def parse_scale(scale: str) -> Tuple[float, ...]:
     try:
         return tuple(float(x) for x in scale.split(","))
@@ -123,7 +184,7 @@ def add_interpolation_flag(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
         "--interpolation_mode",
         "-i",
-        help="Interpolation mode (median, mode, nearest, bilinear or bicubic)",
+        help="Interpolation mode (median, mode, label_mode, nearest, bilinear, bicubic, max, min or average)",
         default="default",
     )
 
@@ -206,14 +267,7 @@ def get_executor_for_args(
         executor = cluster_tools.get_executor("multiprocessing", max_workers=jobs)
         logging.info("Using pool of {} workers.".format(jobs))
     elif args.distribution_strategy == "multiprocessing":
-        # Also accept "processes" instead of job to be compatible with segmentation-tools.
-        # In the long run, the args should be unified and provided by the clustertools.
-        if "jobs" in args:
-            jobs = args.jobs
-        elif "processes" in args:
-            jobs = args.processes
-        else:
-            jobs = cpu_count()
+        jobs = get_job_count(args)
 
         executor = cluster_tools.get_executor("multiprocessing", max_workers=jobs)
         logging.info("Using pool of {} workers.".format(jobs))
@@ -241,6 +295,54 @@ def get_executor_for_args(
 times = {}
 
 
+def parse_memory_size(memory_size: str) -> int:
+    """
+    Parses a memory size like slurm's --mem option (e.g., "500M" or "4G") and
+    returns it in bytes. Sizes without a unit are interpreted as megabytes.
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$", memory_size.upper())
+    if match is None:
+        raise argparse.ArgumentTypeError("Invalid memory size: {}".format(memory_size))
+    value, unit = match.groups()
+    exponent = "KMGT".index(unit or "M") + 1
+    return int(float(value) * 1024 ** exponent)
+
+
+def get_memory_per_job(args: Optional[argparse.Namespace]) -> Optional[int]:
+    """
+    Returns the memory (in bytes) which a single slurm job may use according to
+    --job_resources or None if no limit is known (e.g., for multiprocessing).
+    """
+    if args is None or getattr(args, "distribution_strategy", None) != "slurm":
+        return None
+    job_resources = json.loads(args.job_resources or "{}")
+    if "mem" not in job_resources:
+        return None
+    return parse_memory_size(str(job_resources["mem"]))
+
+
+def get_job_count(args: Optional[argparse.Namespace]) -> int:
+    """Returns the number of parallel processes get_executor_for_args will use."""
+    # Also accept "processes" instead of job to be compatible with segmentation-tools.
+    # In the long run, the args should be unified and provided by the clustertools.
+    if args is None:
+        return cpu_count()
+    if "jobs" in args:
+        return args.jobs
+    if "processes" in args:
+        return args.processes
+    return cpu_count()
+
+
+def with_job_count(args: Optional[argparse.Namespace], jobs: int) -> argparse.Namespace:
+    """Returns a copy of args for which get_executor_for_args uses the given number of processes."""
+    if args is None:
+        return argparse.Namespace(distribution_strategy="multiprocessing", jobs=jobs)
+    args = argparse.Namespace(**vars(args))
+    args.jobs = jobs
+    return args
+
+
 def time_start(identifier: str) -> None:
     times[identifier] = time.time()
 
@@ -252,9 +354,18 @@ def time_stop(identifier: str) -> None:
 
 # Waits for all futures to complete and raises an exception
 # as soon as a future resolves with an error.
-def wait_and_ensure_success(futures: List[Future]) -> None:
+# If on_result is passed, it is called with the index and the result of every
+# future as soon as it completes (e.g., to record progress).
+# Returns the results of the futures in the order of the passed futures.
+def wait_and_ensure_success(
+    futures: List[Future], on_result: Optional[Callable[[int, Any], None]] = None
+) -> List[Any]:
+    future_indices = {fut: i for i, fut in enumerate(futures)}
     for fut in as_completed(futures):
-        fut.result()
+        result = fut.result()
+        if on_result is not None:
+            on_result(future_indices[fut], result)
+    return [fut.result() for fut in futures]
 
 
 class BufferedSliceWriter(object):
@@ -391,6 +502,72 @@ class BufferedSliceWriter(object):
         self.close()
 
 
+T = TypeVar("T")
+
+
+def iterate_prefetched(
+    func: Callable[..., T],
+    args_list: Iterable[Tuple[Any, ...]],
+    prefetch_count: int = 1,
+) -> Iterator[T]:
+    """
+    Yields func(*args) for every args of args_list. The next prefetch_count
+    results are computed by as many background threads while the current one is
+    being processed by the caller (double buffering for prefetch_count=1). This
+    is useful to overlap I/O like wkw reads or image decoding, which release the
+    GIL, with computations. With prefetch_count=0, the results are computed one
+    after another by the calling thread.
+    """
+    if prefetch_count == 0:
+        yield from (func(*args) for args in args_list)
+        return
+    with ThreadPoolExecutor(max_workers=prefetch_count) as executor:
+        futures: Deque[Future] = deque()
+        for args in args_list:
+            futures.append(executor.submit(func, *args))
+            if len(futures) > prefetch_count:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
+
+
+class BackgroundWriter(object):
+    """
+    Runs write functions in a background thread in the order in which they are
+    submitted, so that writing overlaps with the following reads and computations.
+    At most max_pending_writes writes (and their buffers) are held back at once.
+    Closing the writer waits for all writes and raises their exceptions.
+    """
+
+    def __init__(self, max_pending_writes: int = 1):
+        self.max_pending_writes = max_pending_writes
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures: List[Future] = []
+
+    def submit(self, write_func: Callable[..., Any], *args: Any) -> None:
+        while len(self.futures) >= self.max_pending_writes:
+            self.futures.pop(0).result()
+        self.futures.append(self.executor.submit(write_func, *args))
+
+    def close(self) -> None:
+        try:
+            wait_and_ensure_success(self.futures)
+        finally:
+            self.futures = []
+            self.executor.shutdown()
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(
+        self,
+        _type: Optional[Type[BaseException]],
+        _value: Optional[BaseException],
+        _tb: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+
 def log_memory_consumption(additional_output: str = "") -> None:
     pid = os.getpid()
     process = psutil.Process(pid)